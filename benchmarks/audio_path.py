@@ -0,0 +1,168 @@
+"""Benchmark the S3-to-Whisper audio path: temp-file download vs. spooled streaming.
+
+The "legacy" variant reproduces the original flow (``s3.download_file`` into a
+temporary directory, then ``requests`` encoding ``files=`` in memory). The
+"spooled" variant uses ``fetch_audio`` and ``request_transcription`` from the
+ingestion Lambda. Each variant runs in a fresh interpreter so peak RSS is not
+shared between them. S3 and the Whisper endpoint are stubbed in-process, so
+nothing touches the network.
+
+Usage:
+    python benchmarks/audio_path.py --size-mb 8 --runs 5
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from typing import Any, Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKFLOW_DIR = os.path.join(REPO_ROOT, "whatsapp-triggered-workflow")
+VARIANTS = ("legacy", "spooled")
+MEDIA_TYPE = "audio/ogg; codecs=opus"
+FILENAME = "benchmark.ogg"
+KEY = f"benchmark/{FILENAME}"
+
+
+class FileBackedS3:
+    """Just enough of the S3 client to serve one object stored on local disk."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key.replace("/", "_"))
+
+    def get_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        path = self._path(Key)
+        body = open(path, "rb")
+        body.iter_chunks = lambda chunk_size=1024: iter(  # type: ignore[attr-defined]
+            lambda: body.read(chunk_size), b""
+        )
+        return {"Body": body, "ContentLength": os.path.getsize(path)}
+
+    def download_file(self, Bucket: str, Key: str, Filename: str) -> None:
+        shutil.copyfile(self._path(Key), Filename)
+
+
+def install_stubs(root: str) -> None:
+    """Replace boto3 and the HTTP transport before the Lambda module is imported."""
+    s3 = FileBackedS3(root)
+    boto3 = types.ModuleType("boto3")
+    boto3.client = lambda name, **kwargs: s3 if name == "s3" else object()  # type: ignore[attr-defined]
+    sys.modules["boto3"] = boto3
+
+    sys.path.insert(0, os.path.join(REPO_ROOT, "python-dependencies"))
+    sys.path.insert(0, WORKFLOW_DIR)
+    import requests  # type: ignore[import-not-found,import-untyped]
+
+    def send(adapter: Any, request: Any, **kwargs: Any) -> Any:
+        # Drain the body the way a socket would, without holding on to it
+        body = request.body
+        if hasattr(body, "read"):
+            while body.read(64 * 1024):
+                pass
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{"text": "benchmark"}'
+        response.request = request
+        return response
+
+    requests.adapters.HTTPAdapter.send = send
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+
+def run_legacy(lf: Any) -> None:
+    import requests  # type: ignore[import-not-found,import-untyped]
+
+    with tempfile.TemporaryDirectory() as td:
+        local_filename = os.path.join(td, FILENAME)
+        lf.s3.download_file(lf.S3_BUCKET, KEY, local_filename)
+        with open(local_filename, "rb") as file:
+            requests.post(
+                "https://api.openai.com/v1/audio/transcriptions",
+                timeout=lf.TIMEOUT,
+                headers={"Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"},
+                files={"file": file},
+                data={"model": "whisper-1", "response_format": "json"},
+            ).json()
+
+
+def run_spooled(lf: Any) -> None:
+    buffer, _ = lf.fetch_audio(KEY, MEDIA_TYPE)
+    with buffer:
+        _, transcription = lf.request_transcription(buffer, FILENAME, MEDIA_TYPE)
+    if not transcription["ok"]:
+        raise RuntimeError(transcription)
+
+
+def child(variant: str, root: str, runs: int) -> None:
+    install_stubs(root)
+    import lambda_function as lf  # type: ignore[import-not-found]
+
+    run = run_legacy if variant == "legacy" else run_spooled
+    run(lf)  # warm-up, so import-time allocations are not counted
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies: List[float] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(lf)
+        latencies.append((time.perf_counter() - start) * 1000)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "variant": variant,
+                "latency_ms": latencies,
+                "peak_rss_kb": rss_after,
+                "peak_rss_growth_kb": rss_after - rss_before,
+            }
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=8.0)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--variant", choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument("--root", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        child(args.variant, args.root, args.runs)
+        return
+
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, KEY.replace("/", "_")), "wb") as audio:
+            audio.write(os.urandom(int(args.size_mb * 1024 * 1024)))
+
+        print(f"{args.size_mb:g} MB audio, {args.runs} runs per variant")
+        for variant in VARIANTS:
+            output = subprocess.run(
+                [sys.executable, __file__, "--variant", variant, "--root", root]
+                + ["--runs", str(args.runs)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            latencies = result["latency_ms"]
+            print(
+                f"{variant:>8}: median {statistics.median(latencies):8.1f} ms, "
+                f"max {max(latencies):8.1f} ms, "
+                f"peak RSS {result['peak_rss_kb'] / 1024:7.1f} MB "
+                f"(+{result['peak_rss_growth_kb'] / 1024:.1f} MB over warm-up)"
+            )
+
+
+if __name__ == "__main__":
+    main()
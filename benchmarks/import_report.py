@@ -0,0 +1,105 @@
+"""Per-module import-time report for the Lambda handlers.
+
+Imports a handler in a fresh interpreter under ``python -X importtime``, the
+way the Lambda init phase does, and aggregates each module's self time by
+top-level package. With ``--first-call`` it also triggers the imports that the
+ingestion handler defers until first use (boto3 clients and the OpenAI
+session), to show what the first message of a cold container pays.
+
+``--stub-boto3`` replaces boto3 with an empty stub, for machines where it is
+not installed; boto3's own import time is then missing from the report.
+
+Usage:
+    python benchmarks/import_report.py [--handler gather] [--first-call] [--top 15]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLER_DIRS = {
+    "whatsapp": "whatsapp-triggered-workflow",
+    "gather": "gather-results-workflow",
+}
+
+STUB_BOTO3 = """
+import sys, types
+boto3 = types.ModuleType("boto3")
+boto3.client = lambda name, **kwargs: types.SimpleNamespace()
+sys.modules["boto3"] = boto3
+"""
+
+FIRST_CALL = """
+lambda_function.s3.get()
+if hasattr(lambda_function, "get_openai_session"):
+    lambda_function.socialmessaging.get()
+    lambda_function.get_openai_session()
+"""
+
+
+def run_importtime(handler: str, first_call: bool, stub_boto3: bool) -> str:
+    """Run the import in a child interpreter and return its importtime log."""
+    code = STUB_BOTO3 if stub_boto3 else ""
+    code += (
+        f"import sys; sys.path.insert(0, {os.path.join(REPO_ROOT, HANDLER_DIRS[handler])!r})\n"
+        "import lambda_function\n"
+    )
+    if first_call:
+        code += FIRST_CALL
+    # The handlers add ./python-dependencies to sys.path, relative to the cwd
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+
+
+def parse_importtime(log: str) -> List[Tuple[str, int, int]]:
+    """Parse ``-X importtime`` lines into (module, self us, cumulative us)."""
+    rows = []
+    for line in log.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--handler", choices=sorted(HANDLER_DIRS), default="whatsapp")
+    parser.add_argument("--first-call", action="store_true")
+    parser.add_argument("--stub-boto3", action="store_true")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    rows = parse_importtime(
+        run_importtime(args.handler, args.first_call, args.stub_boto3)
+    )
+    by_package: Dict[str, int] = defaultdict(int)
+    for name, self_us, _ in rows:
+        by_package[name.split(".")[0]] += self_us
+
+    total_ms = sum(by_package.values()) / 1000
+    print(f"{args.handler} handler: {len(rows)} modules, {total_ms:.1f} ms total")
+    print(f"{'package':<28}{'self ms':>10}")
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[
+        : args.top
+    ]:
+        print(f"{package:<28}{self_us / 1000:>10.1f}")
+
+    print(f"\n{'slowest modules':<44}{'self ms':>10}{'cumul. ms':>11}")
+    for name, self_us, cumulative_us in sorted(rows, key=lambda row: -row[1])[
+        : args.top
+    ]:
+        print(f"{name:<44}{self_us / 1000:>10.1f}{cumulative_us / 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""Offline cold-start and per-message latency benchmark for the ingestion Lambda.
+
+Imports the handler in a fresh interpreter, the way a new Lambda container
+does, then replays the canned SNS events in ``benchmarks/events`` through
+``lambda_handler``. AWS is replaced by the in-memory ``fake_services`` clients
+and OpenAI by a ``FakeOpenAIServer`` in the parent process, both selected
+through the Lambda's own configuration (FAKE_AWS_SERVICES, OPENAI_BASE_URL).
+Each pipeline stage is timed by wrapping the module function that implements
+it, and the report lists:
+
+- init: module import time, plus the first (cold) invocation, which pays for
+  the imports and clients the handler defers until first use;
+- per-stage p50/p95/p99 over all warm invocations;
+- peak RSS of the child interpreter.
+
+``--latency-ms`` and ``--error-rate`` shape the fake API, to measure
+concurrency and retries. Message ids get a per-replay suffix so the dedup ledger does not skip them,
+and both result caches are disabled unless ``--warm-caches`` is given.
+Nothing touches the network.
+
+Usage:
+    python benchmarks/ingestion_benchmark.py --replays 20 --latency-ms 300
+"""
+
+import argparse
+import copy
+import glob
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKFLOW_DIR = os.path.join(REPO_ROOT, "whatsapp-triggered-workflow")
+EVENTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "events")
+
+# Stage name -> ingestion module function that implements it
+STAGES = {
+    "ledger_claim": "claim_message",
+    "s3_fetch_audio": "fetch_audio",
+    "whisper": "request_transcription",
+    "gpt": "request_structure",
+    "s3_persist": "persist_message_to_s3",
+    "ledger_complete": "complete_message",
+    "message": "process_message",
+}
+
+
+class BenchmarkContext:
+    """Lambda context with a fixed time budget."""
+
+    def __init__(self, budget_seconds: float = 900.0) -> None:
+        self._deadline = time.monotonic() + budget_seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self._deadline - time.monotonic()) * 1000)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def load_events(pattern: str) -> List[Dict[str, Any]]:
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise SystemExit(f"no events match {pattern}")
+    events = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            events.append(json.load(file))
+    return events
+
+
+def with_replay_ids(event: Dict[str, Any], replay: int) -> Dict[str, Any]:
+    """Copy an SNS event, suffixing every WhatsApp message id with `replay`."""
+    event = copy.deepcopy(event)
+    for record in event.get("Records", []):
+        sns_message = json.loads(record["Sns"]["Message"])
+        entry = json.loads(sns_message["whatsAppWebhookEntry"])
+        for change in entry.get("changes", []):
+            for message in change.get("value", {}).get("messages", []):
+                message["id"] = f"{message['id']}.{replay}"
+        sns_message["whatsAppWebhookEntry"] = json.dumps(entry)
+        record["Sns"]["Message"] = json.dumps(sns_message)
+    return event
+
+
+def instrument(lf: Any, timings: Dict[str, List[float]]) -> None:
+    """Wrap each stage function of the ingestion module with a timer."""
+
+    def timed(stage: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[stage].append((time.perf_counter() - start) * 1000)
+
+        return wrapper
+
+    for stage, name in STAGES.items():
+        setattr(lf, name, timed(stage, getattr(lf, name)))
+    media = lf.socialmessaging.get()
+    media.get_whatsapp_message_media = timed(
+        "media_download", media.get_whatsapp_message_media
+    )
+
+
+def child(args: argparse.Namespace) -> None:
+    sys.path.insert(0, WORKFLOW_DIR)
+
+    start = time.perf_counter()
+    import lambda_function as lf  # type: ignore[import-not-found]
+
+    import_ms = (time.perf_counter() - start) * 1000
+
+    events = load_events(args.events)
+    timings: Dict[str, List[float]] = defaultdict(list)
+    start = time.perf_counter()
+    lf.lambda_handler(with_replay_ids(events[0], 0), BenchmarkContext())
+    cold_ms = (time.perf_counter() - start) * 1000
+
+    instrument(lf, timings)
+    for replay in range(1, args.replays + 1):
+        for event in events:
+            start = time.perf_counter()
+            lf.lambda_handler(with_replay_ids(event, replay), BenchmarkContext())
+            timings["invocation"].append((time.perf_counter() - start) * 1000)
+
+    print(
+        json.dumps(
+            {
+                "import_ms": import_ms,
+                "cold_invocation_ms": cold_ms,
+                "init_report": lf.init_report(),
+                "timings": timings,
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", default=os.path.join(EVENTS_DIR, "*.json"))
+    parser.add_argument("--replays", type=int, default=10)
+    parser.add_argument(
+        "--latency-ms", type=float, default=0.0, help="simulated OpenAI latency"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--audio-seconds", type=float, default=30.0)
+    parser.add_argument("--in-flight", type=int, default=1)
+    parser.add_argument("--warm-caches", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print the raw results")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    sys.path.insert(0, REPO_ROOT)
+    from fake_services.openai_server import FakeOpenAIServer
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=REPO_ROOT,
+        FAKE_AWS_SERVICES="memory",
+        FAKE_MEDIA_SECONDS=str(args.audio_seconds),
+        OPENAI_API_KEY="benchmark",
+        MAX_IN_FLIGHT_MESSAGES=str(args.in_flight),
+    )
+    if not args.warm_caches:
+        env.update(STRUCTURE_CACHE_ENABLED="0", TRANSCRIPTION_CACHE_ENABLED="0")
+    with FakeOpenAIServer(
+        latency=args.latency_ms / 1000, error_rate=args.error_rate, retry_after=0
+    ) as server:
+        env["OPENAI_BASE_URL"] = server.base_url
+        # The handler adds ./python-dependencies to sys.path, relative to the cwd
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child"] + sys.argv[1:],
+            cwd=REPO_ROOT,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        api_stats = server.stats
+    result = json.loads(output.strip().splitlines()[-1])
+    result["api_stats"] = api_stats
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(f"{'import':<31}{result['import_ms']:8.1f} ms")
+    print(f"{'cold invocation':<31}{result['cold_invocation_ms']:8.1f} ms")
+    for name, elapsed in result["init_report"]["lazy_imports_ms"].items():
+        print(f"  import {name:<22}{elapsed:8.1f} ms")
+    print(f"{'peak RSS':<31}{result['peak_rss_kb'] / 1024:8.1f} MB")
+    for path, stats in sorted(api_stats.items()):
+        print(f"{path:<31}{stats['requests']:8d} requests, {stats['errors']} failed")
+    print()
+    print(f"{'stage':<17}{'count':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for stage in ["media_download", *STAGES, "invocation"]:
+        values = result["timings"].get(stage)
+        if not values:
+            continue
+        print(
+            f"{stage:<17}{len(values):>6}"
+            + "".join(f"{percentile(values, pct):>9.1f}" for pct in (50, 95, 99))
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""Local stand-ins for the AWS and OpenAI services the workflows call.
+
+Both Lambdas pick them up through configuration, with the repository root on
+PYTHONPATH:
+
+- FAKE_AWS_SERVICES=memory (or a directory path) makes their boto3 clients
+  fakes from `fake_services.aws`; a directory lets separate processes share
+  one bucket.
+- OPENAI_BASE_URL=http://127.0.0.1:8787/v1 sends OpenAI calls to
+  `python -m fake_services.openai_server` (or an in-process
+  `fake_services.openai_server.FakeOpenAIServer`).
+- Messages sent to the enrichment work queues stay in the fake SQS until
+  `python -m fake_services.sqs_worker` (or `sqs_worker.run_consumer`) feeds
+  them to the Lambda, as the queue's event source mapping would.
+
+This module doubles as the `boto3` replacement: it exposes `client`.
+"""
+
+from .aws import FakeClientError, FakeS3, FakeSocialMessaging, FakeSQS, client
+from .media import synthetic_opus
+
+__all__ = [
+    "FakeClientError",
+    "FakeS3",
+    "FakeSocialMessaging",
+    "FakeSQS",
+    "client",
+    "synthetic_opus",
+]
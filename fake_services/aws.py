@@ -0,0 +1,593 @@
+"""In-process fakes for the boto3 `s3`, `sqs` and `socialmessaging` clients.
+
+Only the calls and arguments the workflows use are implemented, with the same
+response shapes and error codes as the real services. Objects and queues live
+in memory, or under a local directory (one file per key, one per queue) so
+that several processes, such as the ingestion and gather Lambdas run one after
+the other, or a producer and its queue consumers, see the same bucket.
+"""
+
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from typing import IO, Any, Dict, Iterator, List, Optional
+
+from .media import synthetic_opus
+
+DEFAULT_MEDIA_SECONDS = 20.0
+LIST_MAX_KEYS = 1000
+MIN_PART_BYTES = 5 * 1024 * 1024  # for every multipart part but the last
+MAX_PARTS = 10000
+DEFAULT_VISIBILITY_TIMEOUT = 30.0  # seconds, as for a new SQS queue
+RECEIVE_POLL_INTERVAL = 0.05  # seconds between checks while long polling
+
+
+class FakeClientError(Exception):
+    """Shaped like botocore's ClientError: the code is in `response["Error"]`."""
+
+    def __init__(self, code: str, operation: str, status: int = 400) -> None:
+        super().__init__(
+            f"An error occurred ({code}) when calling the {operation} operation"
+        )
+        self.response = {
+            "Error": {"Code": code},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        }
+
+
+class FakeStreamingBody(io.BytesIO):
+    """Object body with botocore StreamingBody's chunked iteration."""
+
+    def iter_chunks(self, chunk_size: int = 1024) -> Iterator[bytes]:
+        return iter(lambda: self.read(chunk_size), b"")
+
+
+def etag(data: bytes) -> str:
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+class FakeS3:
+    """S3 client fake backed by a dict, or by files under `root` if given.
+
+    Args:
+        root: Directory holding one subdirectory per bucket; None keeps
+            objects in memory.
+    """
+
+    def __init__(self, root: Optional[str] = None) -> None:
+        self.root = root
+        self._objects: Dict[str, Dict[str, bytes]] = {}
+        # Multipart uploads in progress, by upload ID; kept in memory only
+        self._uploads: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    # Storage
+
+    def _path(self, bucket: str, key: str) -> str:
+        assert self.root is not None
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def _load(self, bucket: str, key: str) -> Optional[bytes]:
+        if self.root is None:
+            return self._objects.get(bucket, {}).get(key)
+        try:
+            with open(self._path(bucket, key), "rb") as file:
+                return file.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+
+    def _store(self, bucket: str, key: str, data: bytes) -> None:
+        if self.root is None:
+            self._objects.setdefault(bucket, {})[key] = data
+            return
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        with open(partial, "wb") as file:
+            file.write(data)
+        os.replace(partial, path)
+
+    @contextlib.contextmanager
+    def _locked(self, bucket: str) -> Iterator[None]:
+        """Serialize writes to a bucket across threads and, on disk, processes.
+
+        Conditional puts read and then write the object, so a directory shared
+        by several processes needs a file lock as well as the thread lock.
+        """
+        with self._lock:
+            if self.root is None:
+                yield
+                return
+            import fcntl
+
+            path = os.path.join(self.root, ".locks", f"{bucket}.lock")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+
+    def _remove(self, bucket: str, key: str) -> None:
+        if self.root is None:
+            self._objects.get(bucket, {}).pop(key, None)
+            return
+        try:
+            os.remove(self._path(bucket, key))
+        except FileNotFoundError:
+            pass
+
+    def _keys(self, bucket: str) -> List[str]:
+        if self.root is None:
+            return sorted(self._objects.get(bucket, {}))
+        base = os.path.join(self.root, bucket)
+        keys = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                if name.endswith(".partial"):
+                    continue
+                relative = os.path.relpath(os.path.join(directory, name), base)
+                keys.append(relative.replace(os.sep, "/"))
+        return sorted(keys)
+
+    def _get(self, bucket: str, key: str, operation: str) -> bytes:
+        data = self._load(bucket, key)
+        if data is None:
+            raise FakeClientError("NoSuchKey", operation, 404)
+        return data
+
+    # Client API
+
+    def put_object(
+        self,
+        Bucket: str,
+        Key: str,
+        Body: Any = b"",
+        IfNoneMatch: Optional[str] = None,
+        IfMatch: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        data = Body.read() if hasattr(Body, "read") else Body
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self._locked(Bucket):
+            existing = self._load(Bucket, Key)
+            if IfNoneMatch == "*" and existing is not None:
+                raise FakeClientError("PreconditionFailed", "PutObject", 412)
+            if IfMatch is not None and (existing is None or etag(existing) != IfMatch):
+                raise FakeClientError("PreconditionFailed", "PutObject", 412)
+            self._store(Bucket, Key, data)
+        return {"ETag": etag(data)}
+
+    def get_object(
+        self,
+        Bucket: str,
+        Key: str,
+        Range: Optional[str] = None,
+        IfMatch: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        data = self._get(Bucket, Key, "GetObject")
+        if IfMatch is not None and etag(data) != IfMatch:
+            raise FakeClientError("PreconditionFailed", "GetObject", 412)
+        size = len(data)
+        response: Dict[str, Any] = {"ETag": etag(data)}
+        if Range:
+            match = re.fullmatch(r"bytes=(\d*)-(\d*)", Range)
+            if not match or match.groups() == ("", ""):
+                raise FakeClientError("InvalidRange", "GetObject", 416)
+            first, last = match.groups()
+            if first:
+                start, end = int(first), int(last) if last else size - 1
+            else:
+                start, end = max(size - int(last), 0), size - 1
+            if start >= size:
+                raise FakeClientError("InvalidRange", "GetObject", 416)
+            end = min(end, size - 1)
+            response["ContentRange"] = f"bytes {start}-{end}/{size}"
+            data = data[start : end + 1]
+        response.update(
+            Body=FakeStreamingBody(data),
+            ContentLength=len(data),
+            LastModified=datetime.datetime.now(datetime.timezone.utc),
+        )
+        return response
+
+    def head_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        data = self._get(Bucket, Key, "HeadObject")
+        return {"ETag": etag(data), "ContentLength": len(data)}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        with self._locked(Bucket):
+            self._remove(Bucket, Key)
+        return {}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, **kwargs: Any) -> None:
+        with open(Filename, "rb") as file:
+            self.put_object(Bucket=Bucket, Key=Key, Body=file.read())
+
+    def upload_fileobj(
+        self, Fileobj: IO[bytes], Bucket: str, Key: str, **kwargs: Any
+    ) -> None:
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def download_file(
+        self, Bucket: str, Key: str, Filename: str, **kwargs: Any
+    ) -> None:
+        data = self._get(Bucket, Key, "HeadObject")
+        with open(Filename, "wb") as file:
+            file.write(data)
+
+    def create_multipart_upload(
+        self, Bucket: str, Key: str, **kwargs: Any
+    ) -> Dict[str, Any]:
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {"bucket": Bucket, "key": Key, "parts": {}}
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def _upload(self, bucket: str, key: str, upload_id: str, operation: str) -> Dict:
+        upload = self._uploads.get(upload_id)
+        if upload is None or (upload["bucket"], upload["key"]) != (bucket, key):
+            raise FakeClientError("NoSuchUpload", operation, 404)
+        return upload
+
+    def upload_part(
+        self,
+        Bucket: str,
+        Key: str,
+        UploadId: str,
+        PartNumber: int,
+        Body: Any = b"",
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        data = Body.read() if hasattr(Body, "read") else Body
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not 1 <= PartNumber <= MAX_PARTS:
+            raise FakeClientError("InvalidArgument", "UploadPart")
+        with self._lock:
+            self._upload(Bucket, Key, UploadId, "UploadPart")["parts"][
+                PartNumber
+            ] = data
+        return {"ETag": etag(data)}
+
+    def complete_multipart_upload(
+        self,
+        Bucket: str,
+        Key: str,
+        UploadId: str,
+        MultipartUpload: Dict[str, Any],
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        operation = "CompleteMultipartUpload"
+        with self._locked(Bucket):
+            uploaded = self._upload(Bucket, Key, UploadId, operation)["parts"]
+            parts = MultipartUpload.get("Parts", [])
+            numbers = [part["PartNumber"] for part in parts]
+            if not parts or numbers != sorted(set(numbers)):
+                raise FakeClientError("InvalidPartOrder", operation)
+            chunks = []
+            for part in parts:
+                data = uploaded.get(part["PartNumber"])
+                if data is None or etag(data) != part["ETag"]:
+                    raise FakeClientError("InvalidPart", operation)
+                chunks.append(data)
+            if any(len(data) < MIN_PART_BYTES for data in chunks[:-1]):
+                raise FakeClientError("EntityTooSmall", operation)
+            data = b"".join(chunks)
+            self._store(Bucket, Key, data)
+            del self._uploads[UploadId]
+        return {"Bucket": Bucket, "Key": Key, "ETag": etag(data)}
+
+    def abort_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, **kwargs: Any
+    ) -> Dict[str, Any]:
+        with self._lock:
+            self._upload(Bucket, Key, UploadId, "AbortMultipartUpload")
+            del self._uploads[UploadId]
+        return {}
+
+    def generate_presigned_url(
+        self,
+        ClientMethod: str,
+        Params: Dict[str, Any],
+        ExpiresIn: int = 3600,
+        **kwargs: Any,
+    ) -> str:
+        """A file:// URL under a directory root; an S3-shaped one in memory."""
+        if ClientMethod != "get_object":
+            raise NotImplementedError(f"no presigned {ClientMethod}")
+        if self.root is not None:
+            return "file://" + os.path.abspath(
+                self._path(Params["Bucket"], Params["Key"])
+            )
+        return (
+            f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}"
+            f"?X-Amz-Expires={ExpiresIn}&X-Amz-Signature=fake"
+        )
+
+    def list_objects_v2(
+        self,
+        Bucket: str,
+        Prefix: str = "",
+        Delimiter: str = "",
+        StartAfter: str = "",
+        ContinuationToken: str = "",
+        MaxKeys: int = LIST_MAX_KEYS,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        after = ContinuationToken or StartAfter
+        contents: List[Dict[str, Any]] = []
+        prefixes: List[str] = []
+        truncated = False
+        last = ""
+        for key in self._keys(Bucket):
+            if not key.startswith(Prefix) or key <= after:
+                continue
+            common = None
+            if Delimiter and Delimiter in key[len(Prefix) :]:
+                common = key[: key.index(Delimiter, len(Prefix)) + len(Delimiter)]
+                if prefixes and prefixes[-1] == common:
+                    continue
+            if len(contents) + len(prefixes) >= MaxKeys:
+                truncated = True
+                break
+            if common is not None:
+                prefixes.append(common)
+                # Resume after every key under the common prefix
+                last = common + "\uffff"
+                continue
+            data = self._load(Bucket, key) or b""
+            contents.append(
+                {
+                    "Key": key,
+                    "Size": len(data),
+                    "ETag": etag(data),
+                    "LastModified": datetime.datetime.now(datetime.timezone.utc),
+                }
+            )
+            last = key
+        response: Dict[str, Any] = {
+            "KeyCount": len(contents) + len(prefixes),
+            "IsTruncated": truncated,
+            "Prefix": Prefix,
+        }
+        if contents:
+            response["Contents"] = contents
+        if prefixes:
+            response["CommonPrefixes"] = [{"Prefix": prefix} for prefix in prefixes]
+        if truncated:
+            response["NextContinuationToken"] = last
+        return response
+
+    def get_paginator(self, operation_name: str) -> "FakePaginator":
+        if operation_name != "list_objects_v2":
+            raise NotImplementedError(operation_name)
+        return FakePaginator(self)
+
+
+class FakePaginator:
+    """`list_objects_v2` paginator, honoring `PaginationConfig["PageSize"]`."""
+
+    def __init__(self, s3: FakeS3) -> None:
+        self.s3 = s3
+
+    def paginate(self, **kwargs: Any) -> Iterator[Dict[str, Any]]:
+        config = kwargs.pop("PaginationConfig", {})
+        kwargs["MaxKeys"] = config.get("PageSize", LIST_MAX_KEYS)
+        while True:
+            page = self.s3.list_objects_v2(**kwargs)
+            yield page
+            if not page["IsTruncated"]:
+                return
+            kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+
+class FakeSQS:
+    """sqs client fake for standard queues, named by the last part of their URL.
+
+    Queues need not be created first. Received messages stay invisible for the
+    visibility timeout and come back unless deleted, with a receive count.
+
+    Args:
+        root: Directory to keep one JSON file per queue in (under `.sqs`);
+            None keeps queues in memory.
+    """
+
+    def __init__(self, root: Optional[str] = None) -> None:
+        self.root = root
+        self._queues: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _queue(self, queue_url: str) -> Iterator[List[Dict[str, Any]]]:
+        """Messages of a queue, locked against other threads and processes."""
+        name = queue_url.rstrip("/").rsplit("/", 1)[-1]
+        with self._lock:
+            if self.root is None:
+                yield self._queues.setdefault(name, [])
+                return
+            import fcntl
+
+            path = os.path.join(self.root, ".sqs", f"{name}.json")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(path) as file:
+                        messages = json.load(file)
+                except FileNotFoundError:
+                    messages = []
+                yield messages
+                with open(f"{path}.partial", "w") as file:
+                    json.dump(messages, file)
+                os.replace(f"{path}.partial", path)
+
+    def send_message(
+        self, QueueUrl: str, MessageBody: str, DelaySeconds: int = 0, **kwargs: Any
+    ) -> Dict[str, Any]:
+        message_id = str(uuid.uuid4())
+        with self._queue(QueueUrl) as messages:
+            messages.append(
+                {
+                    "MessageId": message_id,
+                    "Body": MessageBody,
+                    "visible_at": time.time() + DelaySeconds,
+                    "receive_count": 0,
+                    "receipt": None,
+                }
+            )
+        return {
+            "MessageId": message_id,
+            "MD5OfMessageBody": hashlib.md5(MessageBody.encode("utf-8")).hexdigest(),
+        }
+
+    def receive_message(
+        self,
+        QueueUrl: str,
+        MaxNumberOfMessages: int = 1,
+        VisibilityTimeout: Optional[float] = None,
+        WaitTimeSeconds: float = 0,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        if VisibilityTimeout is None:
+            VisibilityTimeout = DEFAULT_VISIBILITY_TIMEOUT
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            received: List[Dict[str, Any]] = []
+            with self._queue(QueueUrl) as messages:
+                now = time.time()
+                for message in messages:
+                    if len(received) >= MaxNumberOfMessages:
+                        break
+                    if message["visible_at"] > now:
+                        continue
+                    message["receipt"] = uuid.uuid4().hex
+                    message["receive_count"] += 1
+                    message["visible_at"] = now + VisibilityTimeout
+                    received.append(
+                        {
+                            "MessageId": message["MessageId"],
+                            "ReceiptHandle": message["receipt"],
+                            "Body": message["Body"],
+                            "MD5OfBody": hashlib.md5(
+                                message["Body"].encode("utf-8")
+                            ).hexdigest(),
+                            "Attributes": {
+                                "ApproximateReceiveCount": str(message["receive_count"])
+                            },
+                        }
+                    )
+            if received:
+                return {"Messages": received}
+            if time.time() >= deadline:
+                return {}
+            time.sleep(RECEIVE_POLL_INTERVAL)
+
+    def delete_message(
+        self, QueueUrl: str, ReceiptHandle: str, **kwargs: Any
+    ) -> Dict[str, Any]:
+        with self._queue(QueueUrl) as messages:
+            messages[:] = [
+                message for message in messages if message["receipt"] != ReceiptHandle
+            ]
+        return {}
+
+    def change_message_visibility(
+        self,
+        QueueUrl: str,
+        ReceiptHandle: str,
+        VisibilityTimeout: float,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        with self._queue(QueueUrl) as messages:
+            for message in messages:
+                if message["receipt"] == ReceiptHandle:
+                    message["visible_at"] = time.time() + VisibilityTimeout
+                    break
+            else:
+                raise FakeClientError(
+                    "ReceiptHandleIsInvalid", "ChangeMessageVisibility"
+                )
+        return {}
+
+    def get_queue_attributes(self, QueueUrl: str, **kwargs: Any) -> Dict[str, Any]:
+        with self._queue(QueueUrl) as messages:
+            now = time.time()
+            visible = sum(1 for message in messages if message["visible_at"] <= now)
+            return {
+                "Attributes": {
+                    "ApproximateNumberOfMessages": str(visible),
+                    "ApproximateNumberOfMessagesNotVisible": str(
+                        len(messages) - visible
+                    ),
+                }
+            }
+
+
+class FakeSocialMessaging:
+    """socialmessaging client fake that delivers WhatsApp media into `s3`.
+
+    Media registered with `add_media` is served as given; any other media id
+    gets a synthetic Ogg/Opus voice note of `default_seconds`.
+    """
+
+    def __init__(
+        self, s3: FakeS3, default_seconds: float = DEFAULT_MEDIA_SECONDS
+    ) -> None:
+        self.s3 = s3
+        self.default_seconds = default_seconds
+        self.media: Dict[str, Dict[str, Any]] = {}
+
+    def add_media(self, media_id: str, data: bytes, extension: str = "ogg") -> None:
+        self.media[media_id] = {"data": data, "extension": extension}
+
+    def get_whatsapp_message_media(
+        self,
+        mediaId: str,
+        originationPhoneNumberId: str,
+        destinationS3File: Dict[str, str],
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        media = self.media.get(mediaId) or {
+            "data": synthetic_opus(self.default_seconds),
+            "extension": "ogg",
+        }
+        self.s3.put_object(
+            Bucket=destinationS3File["bucketName"],
+            Key=f"{destinationS3File['key']}{mediaId}.{media['extension']}",
+            Body=media["data"],
+        )
+        return {"mimeType": "audio/ogg", "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+
+_clients: Dict[str, Any] = {}
+_clients_lock = threading.Lock()
+
+
+def client(service_name: str, **kwargs: Any) -> Any:
+    """Drop-in for `boto3.client`, returning one shared fake per service.
+
+    The backing store is chosen by the FAKE_AWS_SERVICES environment variable:
+    "memory" (or unset) for in-memory objects, or a directory path. Synthetic
+    voice notes last FAKE_MEDIA_SECONDS.
+    """
+    with _clients_lock:
+        if not _clients:
+            backend = os.environ.get("FAKE_AWS_SERVICES", "memory")
+            s3 = FakeS3(None if backend in ("", "1", "memory") else backend)
+            _clients["s3"] = s3
+            _clients["sqs"] = FakeSQS(s3.root)
+            _clients["socialmessaging"] = FakeSocialMessaging(
+                s3,
+                float(os.environ.get("FAKE_MEDIA_SECONDS", DEFAULT_MEDIA_SECONDS)),
+            )
+    if service_name not in _clients:
+        raise NotImplementedError(f"no fake for the {service_name} service")
+    return _clients[service_name]
@@ -0,0 +1,55 @@
+"""Synthetic WhatsApp media for the fake socialmessaging client."""
+
+import os
+import random
+import struct
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OPUS_FRAMES_PER_SECOND = 50  # 20 ms frames, as WhatsApp voice notes use
+FRAMES_PER_PAGE = 50
+PRE_SKIP = 312
+
+
+def synthetic_opus(seconds: float, packet_bytes: int = 60) -> bytes:
+    """Build a structurally valid Ogg/Opus stream of random-filled packets.
+
+    The packets are not decodable audio, but page layout, granule positions
+    and headers match a real voice note of that length, which is all the
+    ingestion handler reads before sending audio to Whisper.
+
+    Args:
+        seconds: Duration the stream's granule positions describe.
+        packet_bytes: Size of every audio packet (60 bytes is about 24 kbit/s).
+
+    Returns:
+        The Ogg file contents.
+    """
+    sys.path.insert(0, os.path.join(REPO_ROOT, "whatsapp-triggered-workflow"))
+    import ogg  # type: ignore[import-not-found]
+
+    serial = random.getrandbits(32)
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, PRE_SKIP, 48000, 0, 0)
+    vendor = b"fake_services"
+    tags = b"OpusTags" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", 0)
+    pages = [
+        ogg.OggPage(0x02, 0, serial, 0, bytes([len(head)]), head),
+        ogg.OggPage(0, 0, serial, 1, bytes([len(tags)]), tags),
+    ]
+    frames = int(seconds * OPUS_FRAMES_PER_SECOND)
+    granule = PRE_SKIP
+    for first in range(0, frames, FRAMES_PER_PAGE):
+        count = min(FRAMES_PER_PAGE, frames - first)
+        granule += count * ogg.OPUS_SAMPLE_RATE // OPUS_FRAMES_PER_SECOND
+        pages.append(
+            ogg.OggPage(
+                ogg.FLAG_EOS if first + count >= frames else 0,
+                granule,
+                serial,
+                len(pages),
+                bytes([packet_bytes] * count),
+                os.urandom(packet_bytes * count),
+            )
+        )
+    return b"".join(page.to_bytes() for page in pages)
@@ -0,0 +1,274 @@
+"""HTTP server mimicking the OpenAI endpoints the ingestion Lambda calls.
+
+`POST /v1/audio/transcriptions` answers like Whisper and
+`POST /v1/chat/completions` answers like a chat model asked for a JSON schema
+response: the content is a JSON object with a value for every schema
+property, picked deterministically from the report text. Each response is
+delayed by a configurable latency (plus uniform jitter), and a configurable
+fraction of requests fails with 429/500/503, with a Retry-After header on the
+throttling ones, to exercise the Lambda's retries. `GET /stats` returns
+request counters.
+
+Run it standalone and point the Lambda at it:
+
+    python -m fake_services.openai_server --port 8787 --latency-ms 800 --error-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 OPENAI_API_KEY=fake ...
+
+or start it in-process with `FakeOpenAIServer(...).start()`.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Sequence
+
+TRANSCRIPTION_PATH = "/v1/audio/transcriptions"
+CHAT_PATH = "/v1/chat/completions"
+STATS_PATH = "/stats"
+TRANSCRIPT = "Vi una panga con red agallera dentro de la zona de refugio."
+ERROR_STATUSES = (429, 500, 503)
+OPUS_BYTES_PER_SECOND = 3000  # about 24 kbit/s
+
+
+def fake_structure(schema: Dict[str, Any], text: str) -> Dict[str, Any]:
+    """Fill every property of a JSON schema with a value derived from `text`.
+
+    The same text always gets the same values.
+    """
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    words = [word.strip(".,;:¿?¡!") for word in text.split()] or ["reporte"]
+    result: Dict[str, Any] = {}
+    for name, spec in schema.get("properties", {}).items():
+        if "enum" in spec:
+            result[name] = rng.choice(spec["enum"])
+        elif spec.get("type") == "array":
+            result[name] = rng.sample(words, min(3, len(words)))
+        else:
+            result[name] = " ".join(words[:6])
+    return result
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    # Send headers and body in one segment, so delayed ACKs do not add latency
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    server: "FakeOpenAIHTTPServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def send_json(
+        self, status: int, payload: Dict[str, Any], headers: Optional[Dict] = None
+    ) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path != STATS_PATH:
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+        self.send_json(200, self.server.stats_snapshot())
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path not in (TRANSCRIPTION_PATH, CHAT_PATH):
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        config = self.server.config
+        self.server.count(self.path, "requests")
+        delay = config["latency"] + random.uniform(0, config["jitter"])
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < config["error_rate"]:
+            self.server.count(self.path, "errors")
+            status = random.choice(config["error_statuses"])
+            headers = (
+                {"Retry-After": str(config["retry_after"])}
+                if status in (429, 503)
+                else None
+            )
+            self.send_json(
+                status,
+                {"error": {"message": "fake failure", "type": "server_error"}},
+                headers,
+            )
+            return
+
+        if self.path == TRANSCRIPTION_PATH:
+            # Billed duration, guessed from the upload at voice-note bitrates
+            seconds = max(round(len(body) / OPUS_BYTES_PER_SECOND), 1)
+            self.send_json(
+                200,
+                {"text": TRANSCRIPT, "usage": {"type": "duration", "seconds": seconds}},
+            )
+            return
+
+        request = json.loads(body or b"{}")
+        text = next(
+            (
+                message.get("content", "")
+                for message in reversed(request.get("messages", []))
+                if message.get("role") == "user"
+            ),
+            "",
+        )
+        schema = (
+            request.get("response_format", {}).get("json_schema", {}).get("schema", {})
+        )
+        content = json.dumps(fake_structure(schema, text), ensure_ascii=False)
+        prompt_tokens = sum(
+            len(str(message.get("content", ""))) // 4
+            for message in request.get("messages", [])
+        )
+        completion_tokens = len(content) // 4
+        self.send_json(
+            200,
+            {
+                "id": f"chatcmpl-fake{random.getrandbits(48):012x}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": f"{request.get('model', 'gpt-4.1')}-fake",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+        )
+
+
+class FakeOpenAIHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Any, config: Dict[str, Any]) -> None:
+        super().__init__(address, FakeOpenAIHandler)
+        self.config = config
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._stats_lock = threading.Lock()
+
+    def count(self, path: str, counter: str) -> None:
+        with self._stats_lock:
+            stats = self._stats.setdefault(path, {"requests": 0, "errors": 0})
+            stats[counter] += 1
+
+    def stats_snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._stats_lock:
+            return {path: dict(stats) for path, stats in self._stats.items()}
+
+
+class FakeOpenAIServer:
+    """Fake OpenAI API served from a background thread.
+
+    Args:
+        latency: Seconds every response is delayed by.
+        jitter: Up to this many extra seconds, uniformly random.
+        error_rate: Fraction of requests answered with an error status.
+        error_statuses: Statuses errors are drawn from.
+        retry_after: Retry-After seconds sent with 429 and 503 errors.
+        host: Interface to listen on.
+        port: Port to listen on; 0 picks a free one.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_statuses: Sequence[int] = ERROR_STATUSES,
+        retry_after: int = 1,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.config = {
+            "latency": latency,
+            "jitter": jitter,
+            "error_rate": error_rate,
+            "error_statuses": tuple(error_statuses),
+            "retry_after": retry_after,
+        }
+        self.httpd = FakeOpenAIHTTPServer((host, port), self.config)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        """Value for the Lambda's OPENAI_BASE_URL."""
+        host, port = self.httpd.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode()
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Requests and injected errors per endpoint path."""
+        return self.httpd.stats_snapshot()
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--error-statuses",
+        default=",".join(map(str, ERROR_STATUSES)),
+        help="comma-separated HTTP statuses to fail with",
+    )
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        error_statuses=[int(status) for status in args.error_statuses.split(",")],
+        retry_after=args.retry_after,
+        host=args.host,
+        port=args.port,
+    )
+    print(f"Fake OpenAI API at {server.base_url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
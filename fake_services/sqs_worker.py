@@ -0,0 +1,184 @@
+"""Local stand-in for the SQS event source mapping of an enrichment queue.
+
+Polls a fake queue (see `fake_services.aws.FakeSQS`) and invokes a Lambda
+handler with SQS events the way the mapping does: batches of up to
+`batch_size` messages, at most `concurrency` invocations at once, and the
+partial batch response honoured. Failed messages come back after
+`retry_delay` seconds and are dropped, as a dead-letter redrive would, after
+`max_receives` receives.
+
+Run it next to a producer sharing the same FAKE_AWS_SERVICES directory:
+
+    FAKE_AWS_SERVICES=/tmp/cn-dsi OPENAI_BASE_URL=http://127.0.0.1:8787/v1 \\
+        python -m fake_services.sqs_worker --queue-url local/cn-dsi-transcribe \\
+        --concurrency 2 --until-empty
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Set
+
+from .aws import client
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_LAMBDA_DIR = os.path.join(REPO_ROOT, "whatsapp-triggered-workflow")
+POLL_INTERVAL = 0.1  # seconds between polls of an empty queue
+
+logger = logging.getLogger(__name__)
+
+
+def sqs_event(queue_url: str, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Lambda event for a batch of received messages, shaped like SQS's."""
+    name = queue_url.rstrip("/").rsplit("/", 1)[-1]
+    return {
+        "Records": [
+            {
+                "messageId": message["MessageId"],
+                "receiptHandle": message["ReceiptHandle"],
+                "body": message["Body"],
+                "attributes": message.get("Attributes", {}),
+                "md5OfBody": message["MD5OfBody"],
+                "eventSource": "aws:sqs",
+                "eventSourceARN": f"arn:aws:sqs:us-east-1:000000000000:{name}",
+                "awsRegion": "us-east-1",
+            }
+            for message in messages
+        ]
+    }
+
+
+def run_consumer(
+    handler: Callable[[Dict[str, Any], Any], Any],
+    queue_url: str,
+    batch_size: int = 10,
+    concurrency: int = 1,
+    max_receives: int = 3,
+    retry_delay: float = 1.0,
+    until_empty: bool = True,
+) -> Dict[str, int]:
+    """Feed a queue's messages to a Lambda handler until it is drained.
+
+    Args:
+        handler: Lambda handler taking `(event, context)`.
+        queue_url: Queue to consume.
+        batch_size: Messages per invocation.
+        concurrency: Invocations running at the same time.
+        max_receives: Receives after which a failing message is dropped.
+        retry_delay: Seconds before a failed message can be received again.
+        until_empty: Return once the queue is empty; otherwise poll forever.
+
+    Returns:
+        Counts of invocations and of succeeded, failed and dropped messages.
+    """
+    sqs = client("sqs")
+    stats = {"invocations": 0, "succeeded": 0, "failed": 0, "dead_lettered": 0}
+    stats_lock = threading.Lock()
+
+    def invoke(messages: List[Dict[str, Any]]) -> None:
+        try:
+            response = handler(sqs_event(queue_url, messages), None) or {}
+            failed = {
+                item["itemIdentifier"] for item in response.get("batchItemFailures", [])
+            }
+        except Exception:
+            logger.exception("Invocation for %d messages failed", len(messages))
+            failed = {message["MessageId"] for message in messages}
+
+        counts = {"succeeded": 0, "failed": 0, "dead_lettered": 0}
+        for message in messages:
+            receipt = message["ReceiptHandle"]
+            if message["MessageId"] not in failed:
+                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt)
+                counts["succeeded"] += 1
+                continue
+            counts["failed"] += 1
+            receives = int(message["Attributes"]["ApproximateReceiveCount"])
+            if receives >= max_receives:
+                sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=receipt)
+                counts["dead_lettered"] += 1
+            else:
+                sqs.change_message_visibility(
+                    QueueUrl=queue_url,
+                    ReceiptHandle=receipt,
+                    VisibilityTimeout=retry_delay,
+                )
+        with stats_lock:
+            stats["invocations"] += 1
+            for name, count in counts.items():
+                stats[name] += count
+
+    def queue_empty() -> bool:
+        attributes = sqs.get_queue_attributes(QueueUrl=queue_url)["Attributes"]
+        return (
+            int(attributes["ApproximateNumberOfMessages"])
+            + int(attributes["ApproximateNumberOfMessagesNotVisible"])
+            == 0
+        )
+
+    in_flight: Set[Future] = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            while len(in_flight) < concurrency:
+                messages = sqs.receive_message(
+                    QueueUrl=queue_url, MaxNumberOfMessages=batch_size
+                ).get("Messages", [])
+                if not messages:
+                    break
+                in_flight.add(executor.submit(invoke, messages))
+            if in_flight:
+                done, in_flight = wait(
+                    in_flight, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+            elif until_empty and queue_empty():
+                return stats
+            else:
+                time.sleep(POLL_INTERVAL)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queue-url", required=True)
+    parser.add_argument(
+        "--handler",
+        default="lambda_function.lambda_handler",
+        help="module.function to invoke",
+    )
+    parser.add_argument(
+        "--lambda-dir",
+        default=DEFAULT_LAMBDA_DIR,
+        help="directory the handler module is imported from",
+    )
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--max-receives", type=int, default=3)
+    parser.add_argument("--retry-delay", type=float, default=1.0)
+    parser.add_argument("--until-empty", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sys.path.insert(0, args.lambda_dir)
+    module_name, _, function_name = args.handler.rpartition(".")
+    handler = getattr(importlib.import_module(module_name), function_name)
+    stats = run_consumer(
+        handler,
+        args.queue_url,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        max_receives=args.max_receives,
+        retry_delay=args.retry_delay,
+        until_empty=args.until_empty,
+    )
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
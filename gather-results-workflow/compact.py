@@ -0,0 +1,202 @@
+"""Daily compaction of closed days of message records into per-day rollups.
+
+A day's records (`YYYY-MM-DD/*.json`) are merged, in key order, into
+`_rollups/<day>.ndjson.gz`: newline-delimited JSON written as a series of gzip
+members of about ROLLUP_BLOCK_BYTES each, which together read as one gzip
+file. `_rollups/<day>.index.json`, written after it, holds the byte offset
+and length of every block and, for every record key, its ETag and where it is
+(block and line), so one record can be read with a single ranged GET. Gather
+still lists every day, and reads from a rollup only the records whose listed
+ETag matches the index; the others are fetched from their raw objects.
+
+Only closed days (before today) are compacted. The raw objects are kept:
+they stay the source of truth for ingestion, reprocessing and the ID
+migration. A compacted day whose records changed since (listed ETags differ
+from the index) is compacted again, so gather can read it from the rollup
+again; every run re-checks the last RECHECK_DAYS days, and older days can be
+named explicitly:
+
+    python compact.py                           # closed days that need it
+    python compact.py --day 2025-10-08 --force  # rebuild one day
+"""
+
+import argparse
+import gzip
+import json
+import time
+from datetime import date, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import lambda_function as gather  # type: ignore[import-not-found]
+
+ROLLUP_BLOCK_BYTES = 256 * 1024  # uncompressed NDJSON per gzip member
+RECHECK_DAYS = 7  # compacted days re-checked on every run, for late rewrites
+
+
+def build_rollup(
+    objects: List[Tuple[str, str]], records: Iterable[Dict[str, Any]]
+) -> Tuple[bytes, List[List[int]], Dict[str, Dict[str, Any]]]:
+    """Serialize records into gzip blocks of NDJSON.
+
+    Args:
+        objects: Keys and ETags of the records.
+        records: Parsed records, in the order of `objects`.
+
+    Returns:
+        The rollup body, the `[offset, length]` of every block in it and the
+        location of every record, by key.
+    """
+    body = bytearray()
+    blocks: List[List[int]] = []
+    locations: Dict[str, Dict[str, Any]] = {}
+    lines: List[bytes] = []  # of the open block, each ending in a newline
+    size = 0
+
+    def flush() -> None:
+        nonlocal size
+        if not lines:
+            return
+        data = gzip.compress(b"".join(lines))
+        blocks.append([len(body), len(data)])
+        body.extend(data)
+        lines.clear()
+        size = 0
+
+    for (key, etag), record in zip(objects, records):
+        text = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        line = f"{text}\n".encode("utf-8")
+        locations[key] = {"etag": etag, "block": len(blocks), "line": len(lines)}
+        lines.append(line)
+        size += len(line)
+        if size >= ROLLUP_BLOCK_BYTES:
+            flush()
+    flush()
+    return bytes(body), blocks, locations
+
+
+def compact_day(
+    day: str,
+    force: bool = False,
+    workers: int = gather.GATHER_FETCH_WORKERS,
+    rollups: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    """Write a day's rollup and index, unless the current ones are up to date.
+
+    Args:
+        day: Closed day, YYYY-MM-DD.
+        force: Rebuild even if the index matches the listed records.
+        workers: Records fetched at the same time.
+        rollups: ETags of the rollup indexes by day, if already listed.
+
+    Returns:
+        The day, its `status` ("compacted", "current" or "empty") and the
+        number of records, plus the rollup size and blocks if written.
+
+    Raises:
+        ValueError: If the day is not closed yet.
+    """
+    if date.fromisoformat(day) >= date.today():
+        raise ValueError(f"{day} is not closed; only days before today are compacted")
+    objects = gather.list_day_objects(day, gather.parse_filters({}))
+    if not objects:
+        return {"day": day, "status": "empty", "records": 0}
+    rollups = gather.list_rollups() if rollups is None else rollups
+    if day in rollups and not force:
+        index = gather.load_rollup_index(day, rollups[day])
+        current = {key: record["etag"] for key, record in index["records"].items()}
+        if index.get("version") == gather.ROLLUP_VERSION and current == dict(objects):
+            return {"day": day, "status": "current", "records": len(objects)}
+
+    records = gather.fetch_records(
+        [key for key, _ in objects], workers, gather.read_record
+    )
+    body, blocks, locations = build_rollup(objects, records)
+    rollup_key, index_key = gather.rollup_keys(day)
+    response = gather.s3.put_object(
+        Bucket=gather.S3_BUCKET,
+        Key=rollup_key,
+        Body=body,
+        ContentType="application/x-ndjson",
+    )
+    # The index goes last, so gather never finds one without its rollup
+    index = {
+        "version": gather.ROLLUP_VERSION,
+        "day": day,
+        "compacted_at": time.time(),
+        "rollup": rollup_key,
+        "rollup_etag": response["ETag"],
+        "blocks": blocks,
+        "records": locations,
+    }
+    gather.s3.put_object(
+        Bucket=gather.S3_BUCKET,
+        Key=index_key,
+        Body=json.dumps(index).encode("utf-8"),
+        ContentType="application/json",
+    )
+    return {
+        "day": day,
+        "status": "compacted",
+        "records": len(objects),
+        "bytes": len(body),
+        "blocks": len(blocks),
+    }
+
+
+def days_to_check(today: date) -> List[str]:
+    """Closed days not compacted yet, and the recent ones to re-check."""
+    yesterday = (today - timedelta(days=1)).isoformat()
+    recheck_from = (today - timedelta(days=RECHECK_DAYS)).isoformat()
+    rollups = gather.list_rollups()
+    days = gather.list_days(
+        {"date_from": None, "date_to": yesterday, "senders": [], "types": []}
+    )
+    return [day for day in days if day not in rollups or day >= recheck_from]
+
+
+def run(
+    days: Optional[List[str]] = None,
+    force: bool = False,
+    workers: int = gather.GATHER_FETCH_WORKERS,
+) -> Dict[str, Any]:
+    """Compact the given days, or every closed day that needs it.
+
+    Returns:
+        One result per day (see `compact_day`) and the number compacted.
+    """
+    days = days if days else days_to_check(date.today())
+    rollups = gather.list_rollups()
+    results = [compact_day(day, force, workers, rollups) for day in days]
+    return {
+        "days": results,
+        "compacted": sum(result["status"] == "compacted" for result in results),
+    }
+
+
+def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """AWS Lambda entrypoint, meant to run on a daily schedule.
+
+    Args:
+        event: Optional `days` (YYYY-MM-DD list), `force` and `workers`.
+        context: Lambda context (unused).
+    """
+    return run(
+        event.get("days"),
+        bool(event.get("force", False)),
+        int(event.get("workers", gather.GATHER_FETCH_WORKERS)),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--day", action="append", dest="days", help="day to compact (repeatable)"
+    )
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--workers", type=int, default=gather.GATHER_FETCH_WORKERS)
+    args = parser.parse_args()
+    print(json.dumps(run(args.days, args.force, args.workers)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,1076 @@
 import json
 import csv
+import functools
+import gzip
+import hashlib
 import io
-
-import boto3
+import itertools
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import date
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 AWS_REGION = "us-east-1"
 S3_BUCKET = "causanatura-roc-transcriptions"
 
-s3 = boto3.client("s3", region_name=AWS_REGION)
+# Local stand-ins instead of AWS ("memory" or a directory); see fake_services
+FAKE_AWS_SERVICES = os.environ.get("FAKE_AWS_SERVICES", "")
+
+# Records fetched from S3 at the same time; the client's connection pool is
+# sized to match
+GATHER_FETCH_WORKERS = int(os.environ.get("GATHER_FETCH_WORKERS", 32))
+
+# Rows of every record gathered so far, with the ETag they were built from:
+# one gzipped NDJSON shard per day, and an index of the shards with what a run
+# needs before reading them (the day's fields, prompts and linked aggregates)
+MANIFEST_PREFIX = "_gather/manifest/"
+MANIFEST_INDEX_KEY = f"{MANIFEST_PREFIX}index.json.gz"
+MANIFEST_VERSION = 3  # bump when the entry format changes; older ones are rebuilt
+MANIFEST_READ_WORKERS = 4  # day shards read at the same time for the output
+
+AGGREGATE_PREFIX = "_coalesce/aggregates/"
+PROMPT_REGISTRY_PREFIX = "_prompts/"  # content-hashed prompt definitions
+
+# Closed days merged by compact.py into one gzipped NDJSON rollup each, with
+# an index of where every record is in it. Gather still lists a compacted day,
+# but reads the records whose listed ETag matches the index from the rollup
+# (one ranged GET per block) instead of fetching them one by one
+ROLLUP_PREFIX = "_rollups/"
+ROLLUP_INDEX_SUFFIX = ".index.json"
+ROLLUP_VERSION = 1  # bump when the rollup or index format changes
+
+# With {"output": "s3"} the CSV is streamed to an object under EXPORT_PREFIX
+# in parts of EXPORT_PART_BYTES (S3's minimum is 5 MiB) and returned as a
+# presigned URL valid for EXPORT_URL_EXPIRY seconds (signed with the role's
+# session credentials, it stops working when they expire, whichever is first)
+EXPORT_PREFIX = "_gather/exports/"
+EXPORT_PART_BYTES = int(os.environ.get("GATHER_EXPORT_PART_BYTES", 8 * 1024 * 1024))
+EXPORT_URL_EXPIRY = int(os.environ.get("GATHER_EXPORT_URL_EXPIRY", 3600))
+
+
+class LazyClient:
+    """Stand-in for a boto3 client that is only constructed on first use.
+
+    boto3 itself is imported then too, keeping it out of the init phase.
+    """
+
+    def __init__(self, service_name: str) -> None:
+        self.service_name = service_name
+        self._client: Any = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        """Return the real client, creating it if needed."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    options: Dict[str, Any] = {}
+                    if FAKE_AWS_SERVICES:
+                        import fake_services as boto3
+                    else:
+                        import boto3
+                        from botocore.config import Config
+
+                        options["config"] = Config(
+                            max_pool_connections=GATHER_FETCH_WORKERS,
+                            retries={"mode": "standard", "max_attempts": 5},
+                            tcp_keepalive=True,
+                        )
+
+                    self._client = boto3.client(
+                        self.service_name, region_name=AWS_REGION, **options
+                    )
+        return self._client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
+
+
+s3 = LazyClient("s3")
+
+
+def prompt_hash(definition: Dict[str, Any]) -> str:
+    """Content hash of a prompt definition, as used by the ingestion registry."""
+    return hashlib.sha256(
+        json.dumps(definition, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def inline_prompt(structure: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Prompt embedded in records written before the prompt registry existed."""
+    if "system_message" not in structure:
+        return None
+    return {
+        "version": structure.get("version"),
+        "system_message": structure.get("system_message"),
+        "json_schema": structure.get("json_schema"),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def load_prompt(prompt_key: str) -> Dict[str, Any]:
+    """Fetch a prompt definition from the registry, once per container."""
+    obj = s3.get_object(Bucket=S3_BUCKET, Key=prompt_key)
+    return json.loads(obj["Body"].read().decode("utf-8"))
+
+
+def prompt_reference(structure: Dict[str, Any]) -> Optional[str]:
+    """Return the hash of the prompt a structure was built with, without fetching it."""
+    if "prompt" in structure:
+        return structure["prompt"].get("hash")
+    prompt = inline_prompt(structure)
+    return prompt_hash(prompt) if prompt is not None else None
+
+
+def resolve_prompt(
+    reference: str, inline_prompts: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """Return the full prompt definition for a prompt hash.
+
+    Args:
+        reference: Prompt hash, as returned by `prompt_reference`.
+        inline_prompts: Prompts embedded in legacy records, by hash; any
+            other hash is fetched from the registry.
+    """
+    if reference in inline_prompts:
+        return inline_prompts[reference]
+    return load_prompt(f"{PROMPT_REGISTRY_PREFIX}{reference}.json")
+
+
+@functools.lru_cache(maxsize=1024)
+def load_aggregate(aggregate_key: str, etag: Optional[str] = None) -> Dict[str, Any]:
+    """Fetch the combined record of a coalesced window, once per container.
+
+    The listed ETag is part of the cache key, so a rewritten aggregate is
+    fetched again.
+    """
+    obj = s3.get_object(Bucket=S3_BUCKET, Key=aggregate_key)
+    return json.loads(obj["Body"].read().decode("utf-8"))
+
+
+def parse_filters(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Read the optional filters of a gather event.
+
+    Args:
+        event: May hold `date_from` and `date_to` (inclusive, YYYY-MM-DD, the
+            dates records are filed under), `senders` (phone numbers) and
+            `types` (message types, e.g. "text" or "audio"); a single sender
+            or type may be given as a string.
+
+    Returns:
+        The filters, with `date_to` defaulting to today when only `date_from`
+        is given.
+
+    Raises:
+        ValueError: If a date is not in YYYY-MM-DD format.
+    """
+    date_from = event.get("date_from")
+    date_to = event.get("date_to")
+    for value in (date_from, date_to):
+        if value is not None:
+            date.fromisoformat(value)
+    if date_from and not date_to:
+        date_to = date.today().isoformat()
+    senders = event.get("senders") or []
+    types = event.get("types") or []
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "senders": [senders] if isinstance(senders, str) else list(senders),
+        "types": [types] if isinstance(types, str) else list(types),
+    }
+
+
+def in_date_range(day: str, filters: Dict[str, Any]) -> bool:
+    """Whether a day (YYYY-MM-DD) is within the filters' date range."""
+    if filters["date_from"] and day < filters["date_from"]:
+        return False
+    return not (filters["date_to"] and day > filters["date_to"])
+
+
+def key_matches(key: str, filters: Dict[str, Any]) -> bool:
+    """Whether a record key (YYYY-MM-DD/<sender>-...) passes the key filters."""
+    day, _, name = key.partition("/")
+    senders = tuple(f"{sender}-" for sender in filters["senders"])
+    return in_date_range(day, filters) and (not senders or name.startswith(senders))
+
+
+def day_of(key: str) -> str:
+    return key.partition("/")[0]
+
+
+def rollup_keys(day: str) -> Tuple[str, str]:
+    """Keys of a day's rollup and of its index."""
+    return (
+        f"{ROLLUP_PREFIX}{day}.ndjson.gz",
+        f"{ROLLUP_PREFIX}{day}{ROLLUP_INDEX_SUFFIX}",
+    )
+
+
+def list_days(filters: Dict[str, Any]) -> List[str]:
+    """Day partitions (YYYY-MM-DD) in the bucket within the filters' date range.
+
+    One delimited listing, starting after `date_from` and stopping past
+    `date_to`, so the keys inside the days are not listed.
+    """
+    options = {"Delimiter": "/"}
+    if filters["date_from"]:
+        options["StartAfter"] = filters["date_from"]
+    days: List[str] = []
+    for page in s3.get_paginator("list_objects_v2").paginate(
+        Bucket=S3_BUCKET, **options
+    ):
+        for common in page.get("CommonPrefixes", []):
+            day = common["Prefix"][:-1]
+            # Prefixes starting with "_" hold ingestion state, and sort after dates
+            if day.startswith("_") or (filters["date_to"] and day > filters["date_to"]):
+                return days
+            if in_date_range(day, filters):
+                days.append(day)
+    return days
+
+
+def list_rollups() -> Dict[str, str]:
+    """ETags of the rollup indexes, keyed by the day they compact."""
+    rollups = {}
+    for page in s3.get_paginator("list_objects_v2").paginate(
+        Bucket=S3_BUCKET, Prefix=ROLLUP_PREFIX
+    ):
+        for content in page.get("Contents", []):
+            key = content["Key"]
+            if key.endswith(ROLLUP_INDEX_SUFFIX):
+                rollups[key[len(ROLLUP_PREFIX) : -len(ROLLUP_INDEX_SUFFIX)]] = content[
+                    "ETag"
+                ]
+    return rollups
+
+
+@functools.lru_cache(maxsize=64)
+def load_rollup_index(day: str, etag: Optional[str] = None) -> Dict[str, Any]:
+    """Fetch a day's rollup index; the ETag keys the cache, as for aggregates."""
+    obj = s3.get_object(Bucket=S3_BUCKET, Key=rollup_keys(day)[1])
+    return json.loads(obj["Body"].read().decode("utf-8"))
+
+
+def load_rollup_block(index: Dict[str, Any], block: int) -> List[bytes]:
+    """Fetch one block of a rollup with a ranged GET and split it into lines.
+
+    The GET is conditional on the rollup the index was written for, so a
+    rollup rewritten since fails instead of being read at stale offsets.
+    """
+    offset, length = index["blocks"][block]
+    obj = s3.get_object(
+        Bucket=S3_BUCKET,
+        Key=index["rollup"],
+        Range=f"bytes={offset}-{offset + length - 1}",
+        IfMatch=index["rollup_etag"],
+    )
+    return gzip.decompress(obj["Body"].read()).split(b"\n")
+
+
+def list_day_objects(day: str, filters: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """Keys and ETags of a day's message records, in key order.
+
+    The day is listed whether it is compacted or not, so records rewritten or
+    added after compaction are always seen; with senders given, only their
+    keys are listed.
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    objects = []
+    senders = [f"{sender}-" for sender in filters["senders"]] or [""]
+    for sender in senders:
+        for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{day}/{sender}"):
+            for content in page.get("Contents", []):
+                if content["Key"].endswith(".json"):
+                    objects.append((content["Key"], content["ETag"]))
+    return objects
+
+
+def list_aggregates(filters: Dict[str, Any]) -> Dict[str, str]:
+    """ETags of the coalescing aggregates (of the selected senders, if any)."""
+    paginator = s3.get_paginator("list_objects_v2")
+    aggregates = {}
+    aggregate_prefixes = [
+        f"{AGGREGATE_PREFIX}{sender}-" for sender in filters["senders"]
+    ] or [AGGREGATE_PREFIX]
+    for prefix in aggregate_prefixes:
+        for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix):
+            for content in page.get("Contents", []):
+                aggregates[content["Key"]] = content["ETag"]
+    return aggregates
+
+
+def split_by_rollup(
+    keys: List[str], etags: Dict[str, str], rollups: Dict[str, str]
+) -> Tuple[List[str], Dict[str, List[str]]]:
+    """Split records to fetch into raw objects and records read from rollups.
+
+    A record is read from its day's rollup only if the index holds it with
+    the ETag just listed; records rewritten or added since the day was
+    compacted are fetched from their raw objects.
+
+    Args:
+        keys: Keys of the records to fetch.
+        etags: Listed ETags, by key.
+        rollups: ETags of the rollup indexes, by day (see `list_rollups`).
+
+    Returns:
+        Keys to fetch as raw objects, and keys to read from each day's rollup.
+    """
+    raw = []
+    compacted: Dict[str, List[str]] = {}
+    for key in keys:
+        day = day_of(key)
+        if day in rollups:
+            indexed = load_rollup_index(day, rollups[day])["records"].get(key)
+            if indexed is not None and indexed["etag"] == etags[key]:
+                compacted.setdefault(day, []).append(key)
+                continue
+        raw.append(key)
+    return raw, compacted
+
+
+def s3_error_code(err: Exception) -> Optional[str]:
+    """Return the S3 error code carried by a botocore ClientError, if any."""
+    return getattr(err, "response", {}).get("Error", {}).get("Code")
+
+
+def load_manifest() -> Optional[Dict[str, Any]]:
+    """Return the manifest index of the last run, or None if there is no usable one."""
+    try:
+        obj = s3.get_object(Bucket=S3_BUCKET, Key=MANIFEST_INDEX_KEY)
+    except Exception as err:
+        if s3_error_code(err) in ("NoSuchKey", "404"):
+            return None
+        raise
+    manifest = json.loads(gzip.decompress(obj["Body"].read()).decode("utf-8"))
+    return manifest if manifest.get("version") == MANIFEST_VERSION else None
+
+
+def save_manifest(days: Dict[str, Any], prompts: Dict[str, Any]) -> None:
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "updated_at": time.time(),
+        # Summary of every day's shard, see `summarize_day`
+        "days": days,
+        # Prompts embedded in legacy records, by hash
+        "prompts": prompts,
+    }
+    s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=MANIFEST_INDEX_KEY,
+        Body=gzip.compress(json.dumps(manifest).encode("utf-8")),
+        ContentType="application/json",
+        ContentEncoding="gzip",
+    )
+
+
+def manifest_day_key(day: str) -> str:
+    return f"{MANIFEST_PREFIX}{day}.ndjson.gz"
+
+
+def read_manifest_day(day: str, etag: str) -> Dict[str, Dict[str, Any]]:
+    """Entries of a day's manifest shard, by key, in key order.
+
+    The GET is conditional on the ETag in the index, so a shard rewritten
+    since fails instead of being read.
+    """
+    obj = s3.get_object(Bucket=S3_BUCKET, Key=manifest_day_key(day), IfMatch=etag)
+    entries = {}
+    for line in gzip.decompress(obj["Body"].read()).splitlines():
+        entry = json.loads(line)
+        entries[entry.pop("key")] = entry
+    return entries
+
+
+def load_manifest_day(day: str, etag: str) -> Dict[str, Dict[str, Any]]:
+    """Like `read_manifest_day`, but a missing or rewritten shard reads as empty.
+
+    A run that wrote shards but did not get to save the index leaves them out
+    of step with it; their records are then fetched again.
+    """
+    try:
+        return read_manifest_day(day, etag)
+    except Exception as err:
+        if s3_error_code(err) in ("NoSuchKey", "404", "PreconditionFailed"):
+            return {}
+        raise
+
+
+def save_manifest_day(day: str, entries: Dict[str, Dict[str, Any]]) -> str:
+    """Write a day's manifest shard, in key order; return its ETag."""
+    lines = (json.dumps({"key": key, **entries[key]}) for key in sorted(entries))
+    response = s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=manifest_day_key(day),
+        Body=gzip.compress("\n".join(lines).encode("utf-8")),
+        ContentType="application/x-ndjson",
+        ContentEncoding="gzip",
+    )
+    return response["ETag"]
+
+
+def listing_digest(objects: Iterable[Tuple[str, str]]) -> str:
+    """Digest of keys and ETags in key order, to spot a day that did not change."""
+    digest = hashlib.sha256()
+    for key, etag in objects:
+        digest.update(f"{key}\t{etag}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def summarize_day(etag: str, entries: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Index record of a day's manifest shard.
+
+    Args:
+        etag: ETag of the shard.
+        entries: Its entries, by key.
+
+    Returns:
+        The shard's ETag and record count, the digest of its keys and record
+        ETags, the row fields in order of first appearance, the prompt hashes
+        and the ETags of the linked coalescing aggregates.
+    """
+    fields: Dict[str, None] = {}
+    prompts = set()
+    aggregates = {}
+    for entry in entries.values():
+        fields.update(dict.fromkeys(entry["row"]))
+        if entry.get("prompt"):
+            prompts.add(entry["prompt"])
+        if entry["aggregate"]:
+            aggregates[entry["aggregate"]] = entry.get("aggregate_etag")
+    return {
+        "etag": etag,
+        "records": len(entries),
+        "digest": listing_digest(
+            (key, entries[key]["etag"]) for key in sorted(entries)
+        ),
+        "fields": list(fields),
+        "prompts": sorted(prompts),
+        "aggregates": aggregates,
+    }
+
+
+def entry_current(
+    entry: Optional[Dict[str, Any]], etag: str, aggregates: Dict[str, str]
+) -> bool:
+    """Whether a manifest entry still matches its record and linked aggregate."""
+    if entry is None or entry["etag"] != etag:
+        return False
+    aggregate = entry.get("aggregate")
+    return not aggregate or aggregates.get(aggregate) == entry.get("aggregate_etag")
+
+
+def call_summary(payload: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """The parts of a transcription or structure payload `add_call_usage` reads."""
+    if not payload:
+        return None
+    return {
+        field: payload[field]
+        for field in ("ok", "cache", "deferred", "openai")
+        if field in payload
+    }
+
+
+def materialize(
+    data: Dict[str, Any], prompts: Dict[str, Any], aggregates: Dict[str, str]
+) -> Dict[str, Any]:
+    """Reduce a message record to what gather reports about it.
+
+    Args:
+        data: Message record.
+        prompts: Prompts embedded in legacy records, by hash; the record's is
+            added if it has one. Registry prompts are only referenced by hash.
+        aggregates: ETags of the coalescing aggregates, by key.
+
+    Returns:
+        Manifest entry: the CSV `row`, the `prompt` hash (if structured), the
+        OpenAI `calls` for the usage rollup and the linked `aggregate`.
+    """
+    result = {
+        "from": data.get("from"),
+        "timestamp": data.get("timestamp"),
+        "type": data.get("type"),
+    }
+
+    if result["type"] == "text":
+        result["text"] = data.get("text", {}).get("body")
+        result["audio_file"] = None
+    elif result["type"] == "audio" and (data.get("transcription") or {}).get("ok"):
+        result["text"] = data.get("transcription", {}).get("text")
+        result["audio_file"] = data.get("audio_file")
+    else:
+        result["text"] = None
+        result["audio_file"] = None
+
+    structure = data.get("structure") or {}
+    coalesce = data.get("coalesce") or {}
+    if coalesce.get("aggregate"):
+        aggregate = load_aggregate(
+            coalesce["aggregate"], aggregates.get(coalesce["aggregate"])
+        )
+        structure = aggregate.get("structure") or {}
+        result["coalesce_window"] = coalesce["window_id"]
+
+    if structure.get("ok"):
+        result["version"] = structure.get("version")
+        for field, value in structure.get("result", {}).items():
+            result[field] = value
+    else:
+        result["version"] = None
+
+    entry = {
+        "row": result,
+        "calls": {
+            "transcription": call_summary(data.get("transcription")),
+            "structure": call_summary(structure),
+        },
+        "aggregate": coalesce.get("aggregate"),
+    }
+    if structure:
+        reference = prompt_reference(structure)
+        entry["prompt"] = reference
+        prompt = inline_prompt(structure)
+        if reference is not None and prompt is not None:
+            prompts.setdefault(reference, prompt)
+    return entry
+
+
+def read_record(key: str) -> Dict[str, Any]:
+    """Fetch and parse a message record object."""
+    obj = s3.get_object(Bucket=S3_BUCKET, Key=key)
+    return json.loads(obj["Body"].read().decode("utf-8"))
+
+
+def load_record(key: str, aggregates: Dict[str, str]) -> Dict[str, Any]:
+    """Fetch and parse a message record, and the aggregate it links to, if any."""
+    data = read_record(key)
+    aggregate = (data.get("coalesce") or {}).get("aggregate")
+    if aggregate:
+        load_aggregate(aggregate, aggregates.get(aggregate))
+    return data
+
+
+def fetch_records(
+    keys: Iterable[str], workers: int, load: Callable[[str], Dict[str, Any]]
+) -> Iterator[Dict[str, Any]]:
+    """Load records on a bounded thread pool, yielding them in the order of `keys`.
+
+    Keys are consumed as they are listed, so fetching overlaps the listing;
+    at most `2 * workers` records are in flight or waiting to be yielded.
+
+    Args:
+        keys: Record keys.
+        workers: Records fetched at the same time.
+        load: Fetches one record by key, e.g. `read_record`.
+
+    Yields:
+        Parsed records.
+    """
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        window: Deque[Future] = deque()
+        for key in keys:
+            window.append(executor.submit(load, key))
+            if len(window) >= 2 * workers:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def load_rollup_records(
+    index: Dict[str, Any], keys: List[str], workers: int, aggregates: Dict[str, str]
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Read records from a day's rollup, and the aggregates they link to.
+
+    Every block holding one of the records is fetched once, on a bounded
+    thread pool.
+
+    Args:
+        index: The day's rollup index.
+        keys: Keys of records in the rollup.
+        workers: Blocks fetched at the same time.
+        aggregates: ETags of the coalescing aggregates, by key.
+
+    Yields:
+        Keys and parsed records, in the order of `keys`.
+    """
+    locations = [index["records"][key] for key in keys]
+    blocks = sorted({location["block"] for location in locations})
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(blocks)), 1)) as executor:
+        lines = dict(
+            zip(
+                blocks,
+                executor.map(functools.partial(load_rollup_block, index), blocks),
+            )
+        )
+        records = [
+            json.loads(lines[location["block"]][location["line"]])
+            for location in locations
+        ]
+        linked = set()
+        for data in records:
+            aggregate = (data.get("coalesce") or {}).get("aggregate")
+            if aggregate:
+                linked.add(aggregate)
+        for _ in executor.map(
+            lambda aggregate: load_aggregate(aggregate, aggregates.get(aggregate)),
+            linked,
+        ):
+            pass
+    return zip(keys, records)
+
+
+def sync_day(
+    day: str,
+    summary: Optional[Dict[str, Any]],
+    filters: Dict[str, Any],
+    aggregates: Dict[str, str],
+    rollups: Dict[str, str],
+    prompts: Dict[str, Any],
+    full: bool = False,
+) -> Tuple[Optional[Dict[str, Any]], Dict[str, int]]:
+    """Bring a day's manifest shard up to date with the day's records.
+
+    A day whose listed keys and ETags, and linked aggregates, match its
+    summary is left alone without reading its shard. Otherwise the records
+    that are new or changed are fetched concurrently: raw objects one GET
+    each, records unchanged since their day was compacted a ranged GET per
+    rollup block. Only one day's entries are held at a time.
+
+    Args:
+        day: Day partition, YYYY-MM-DD.
+        summary: The day's index record from the last run, if any.
+        filters: As returned by `parse_filters`; entries outside them are
+            kept as they are.
+        aggregates: ETags of the coalescing aggregates, by key.
+        rollups: ETags of the rollup indexes, by day; empty to fetch every
+            record from its raw object.
+        prompts: Prompts embedded in legacy records, by hash; new ones are
+            added.
+        full: Fetch every listed record again.
+
+    Returns:
+        The day's new index record (the same object if nothing changed, None
+        if the day has no records left), and how many records were listed,
+        fetched, read from rollups and removed.
+    """
+    objects = list_day_objects(day, filters)
+    stats = {"listed": len(objects), "fetched": 0, "from_rollups": 0, "removed": 0}
+    if (
+        summary is not None
+        and not full
+        and not filters["senders"]
+        and summary["digest"] == listing_digest(objects)
+        and all(
+            aggregates.get(aggregate) == etag
+            for aggregate, etag in summary["aggregates"].items()
+        )
+    ):
+        return summary, stats
+
+    previous = load_manifest_day(day, summary["etag"]) if summary else {}
+    etags = dict(objects)
+    stale = [
+        key
+        for key, etag in objects
+        if full or not entry_current(previous.get(key), etag, aggregates)
+    ]
+    raw, compacted = split_by_rollup(stale, etags, rollups)
+    loaded: Iterable[Tuple[str, Dict[str, Any]]] = zip(
+        raw,
+        fetch_records(
+            raw,
+            GATHER_FETCH_WORKERS,
+            functools.partial(load_record, aggregates=aggregates),
+        ),
+    )
+    for rollup_day, keys in compacted.items():
+        index = load_rollup_index(rollup_day, rollups[rollup_day])
+        loaded = itertools.chain(
+            loaded, load_rollup_records(index, keys, GATHER_FETCH_WORKERS, aggregates)
+        )
+    fresh = {}
+    for key, data in loaded:
+        entry = materialize(data, prompts, aggregates)
+        entry["etag"] = etags[key]
+        if entry["aggregate"]:
+            entry["aggregate_etag"] = aggregates.get(entry["aggregate"])
+        fresh[key] = entry
+    # Records gone from the listed part of the day; the rest is kept as is
+    removed = [
+        key for key in previous if key not in etags and key_matches(key, filters)
+    ]
+    stats["fetched"] = len(stale)
+    stats["from_rollups"] = sum(len(keys) for keys in compacted.values())
+    stats["removed"] = len(removed)
+    if summary is not None and previous and not fresh and not removed:
+        return summary, stats
+
+    entries = {key: entry for key, entry in previous.items() if key not in removed}
+    entries.update({key: fresh.get(key) or previous[key] for key in etags})
+    if not entries:
+        return None, stats
+    return summarize_day(save_manifest_day(day, entries), entries), stats
+
+
+def iter_entries(
+    days: Dict[str, Dict[str, Any]], filters: Dict[str, Any]
+) -> Iterator[Dict[str, Any]]:
+    """Manifest entries the filters select, read a few day shards at a time.
+
+    Args:
+        days: Index records of the selected days, by day.
+        filters: As returned by `parse_filters`.
+
+    Yields:
+        Entries in key order.
+    """
+    shards = fetch_records(
+        sorted(days),
+        MANIFEST_READ_WORKERS,
+        lambda day: read_manifest_day(day, days[day]["etag"]),
+    )
+    for entries in shards:
+        for key, entry in entries.items():
+            if key_matches(key, filters) and (
+                not filters["types"] or entry["row"]["type"] in filters["types"]
+            ):
+                yield entry
+
+
+class MultipartUpload:
+    """File-like text sink that uploads what is written as S3 multipart parts.
+
+    At most one part is held in memory. Used as a context manager, the upload
+    is completed on exit, or aborted if the block raised.
+
+    Args:
+        key: Object key to upload to.
+        content_type: Content type of the object.
+    """
+
+    def __init__(self, key: str, content_type: str) -> None:
+        self.key = key
+        self.upload_id = s3.create_multipart_upload(
+            Bucket=S3_BUCKET, Key=key, ContentType=content_type
+        )["UploadId"]
+        self.parts: List[Dict[str, Any]] = []
+        self.buffer = bytearray()
+        self.size = 0
+
+    def write(self, text: str) -> int:
+        self.buffer.extend(text.encode("utf-8"))
+        if len(self.buffer) >= EXPORT_PART_BYTES:
+            self.upload_part()
+        return len(text)
+
+    def upload_part(self) -> None:
+        number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=S3_BUCKET,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": number})
+        self.size += len(self.buffer)
+        self.buffer.clear()
+
+    def __enter__(self) -> "MultipartUpload":
+        return self
+
+    def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+        if exc_type is not None:
+            s3.abort_multipart_upload(
+                Bucket=S3_BUCKET, Key=self.key, UploadId=self.upload_id
+            )
+            return
+        if self.buffer or not self.parts:
+            self.upload_part()
+        s3.complete_multipart_upload(
+            Bucket=S3_BUCKET,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+
+def write_csv(file: Any, fields: List[str], rows: Iterable[Dict[str, Any]]) -> int:
+    """Write a header and one CSV line per row; return the number of rows."""
+    writer = csv.writer(file)
+    writer.writerow(fields)
+    count = 0
+    for row in rows:
+        writer.writerow([row.get(field) for field in fields])
+        count += 1
+    return count
+
+
+def export_csv(
+    fields: List[str], rows: Iterable[Dict[str, Any]]
+) -> Tuple[str, int, int]:
+    """Stream CSV rows to a new object under EXPORT_PREFIX.
+
+    Returns:
+        The object key, the number of rows and the size in bytes.
+    """
+    stamp = time.strftime("%Y-%m-%dT%H-%M-%S", time.gmtime())
+    key = f"{EXPORT_PREFIX}{stamp}-{uuid.uuid4().hex[:8]}.csv"
+    with MultipartUpload(key, "text/csv; charset=utf-8") as upload:
+        count = write_csv(upload, fields, rows)
+    return key, count, upload.size
+
+
+def result_row(entry: Dict[str, Any], include_prompts: bool) -> Dict[str, Any]:
+    """The reported row of a manifest entry."""
+    result = dict(entry["row"])
+    if include_prompts and "prompt" in entry:
+        result["prompt"] = entry["prompt"]
+    return result
+
+
+USAGE_STAGES = ("transcription", "structure")
+
+# Call latencies are counted in log-scale buckets, each LATENCY_BUCKET_RATIO
+# times wider than the last, so the rollup stays the same size however many
+# calls it covers; percentiles read from it are within about 2.5% of exact.
+LATENCY_BUCKET_RATIO = 1.05
+
+
+def new_usage_rollup() -> Dict[str, Dict[str, Any]]:
+    return {
+        stage: {
+            "calls": 0,
+            "failed": 0,
+            "retries": 0,
+            "hedges": {"fired": 0, "won": 0},
+            "usage": {},
+            "models": {},
+            "latency_ms": {"count": 0, "sum": 0.0, "max": 0.0, "buckets": {}},
+        }
+        for stage in USAGE_STAGES
+    }
+
+
+def add_call_usage(
+    rollup: Dict[str, Dict[str, Any]], stage: str, payload: Optional[Dict[str, Any]]
+) -> None:
+    """Add the OpenAI call recorded in a transcription or structure payload.
+
+    Cache hits are skipped: their call info, if any, belongs to the call that
+    filled the cache. So are calls deferred by the open circuit breaker, which
+    never reached OpenAI. Records written before calls were recorded carry none.
+    """
+    if (
+        not payload
+        or (payload.get("cache") or {}).get("hit")
+        or payload.get("deferred")
+    ):
+        return
+    call = payload.get("openai")
+    if not call:
+        return
+    stats = rollup[stage]
+    stats["calls"] += call.get("calls", 1)
+    stats["failed"] += 0 if payload.get("ok") else 1
+    stats["retries"] += call.get("retries") or 0
+    if call.get("hedge"):
+        stats["hedges"]["fired"] += 1
+        stats["hedges"]["won"] += 1 if call["hedge"].get("won") else 0
+    add_latency(stats["latency_ms"], call.get("latency_ms") or 0.0)
+    model = call.get("model") or "unknown"
+    stats["models"][model] = stats["models"].get(model, 0) + 1
+    for field, value in (call.get("usage") or {}).items():
+        if isinstance(value, (int, float)):
+            stats["usage"][field] = stats["usage"].get(field, 0) + value
+
+
+def add_latency(latency: Dict[str, Any], value: float) -> None:
+    """Count a call latency (ms) in a rollup's histogram.
+
+    Bucket 0 holds latencies under 1 ms; bucket i covers
+    [LATENCY_BUCKET_RATIO ** (i - 1), LATENCY_BUCKET_RATIO ** i).
+    """
+    bucket = int(math.log(value, LATENCY_BUCKET_RATIO)) + 1 if value >= 1 else 0
+    latency["buckets"][bucket] = latency["buckets"].get(bucket, 0) + 1
+    latency["count"] += 1
+    latency["sum"] += value
+    latency["max"] = max(latency["max"], value)
+
+
+def percentile(latency: Dict[str, Any], pct: float) -> float:
+    """Nearest-rank percentile of a non-empty latency histogram.
+
+    Taken at the geometric middle of the bucket holding that rank, and never
+    above the largest latency counted.
+    """
+    rank = max(math.ceil(pct / 100 * latency["count"]), 1)
+    seen = 0
+    for bucket in sorted(latency["buckets"]):
+        seen += latency["buckets"][bucket]
+        if seen >= rank:
+            value = LATENCY_BUCKET_RATIO ** (bucket - 0.5) if bucket else 0.5
+            return round(min(value, latency["max"]), 1)
+    return latency["max"]
+
+
+def summarize_usage(rollup: Dict[str, Dict[str, Any]], reports: int) -> Dict[str, Any]:
+    """Totals, per-report averages and latency percentiles per OpenAI stage.
+
+    Args:
+        rollup: Accumulated by `add_call_usage`.
+        reports: Number of reports gathered, for the per-report averages.
+
+    Returns:
+        One summary per stage, keyed by stage name, plus the report count.
+    """
+    summary: Dict[str, Any] = {"reports": reports}
+    for stage, stats in rollup.items():
+        latency = stats["latency_ms"]
+        summary[stage] = {
+            "calls": stats["calls"],
+            "failed": stats["failed"],
+            "retries": stats["retries"],
+            "hedges": stats["hedges"],
+            "models": stats["models"],
+            "usage": stats["usage"],
+            "usage_per_report": (
+                {
+                    field: round(total / reports, 2)
+                    for field, total in stats["usage"].items()
+                }
+                if reports
+                else {}
+            ),
+            "latency_ms": (
+                {
+                    "mean": round(latency["sum"] / latency["count"], 1),
+                    "p50": percentile(latency, 50),
+                    "p95": percentile(latency, 95),
+                    "p99": percentile(latency, 99),
+                    "max": latency["max"],
+                }
+                if latency["count"]
+                else None
+            ),
+        }
+    return summary
 
 
 def lambda_handler(event, context):
-    results = []
+    # Optional date range, senders and message types; see parse_filters
+    filters = parse_filters(event)
+    # Rows are kept in a manifest between runs, so only records that are new or
+    # changed since (by ETag) are fetched; {"full": true} fetches them all again,
+    # from their raw objects
+    full = event.get("full", False)
+    manifest = load_manifest()
+    days = dict(manifest["days"]) if manifest else {}
+    inline_prompts = dict(manifest["prompts"]) if manifest else {}
+    aggregates = list_aggregates(filters)
+    rollups = {} if full else list_rollups()
+    counts = {"listed": 0, "fetched": 0, "from_rollups": 0, "removed": 0}
+    # The manifest is brought up to date one day at a time, including days it
+    # has that are gone from the bucket, so memory does not grow with it
+    changed = manifest is None
+    listed_days = set(list_days(filters))
+    listed_days.update(day for day in days if in_date_range(day, filters))
+    for day in sorted(listed_days):
+        summary, stats = sync_day(
+            day, days.get(day), filters, aggregates, rollups, inline_prompts, full
+        )
+        for counter, value in stats.items():
+            counts[counter] += value
+        if summary is days.get(day):
+            continue
+        changed = True
+        if summary is None:
+            del days[day]
+        else:
+            days[day] = summary
+    if changed:
+        referenced = {
+            reference for day in days.values() for reference in day["prompts"]
+        }
+        inline_prompts = {
+            reference: prompt
+            for reference, prompt in inline_prompts.items()
+            if reference in referenced
+        }
+        save_manifest(days, inline_prompts)
+
+    selected_days = {day: days[day] for day in days if in_date_range(day, filters)}
+    # The header comes from the day summaries, so rows are streamed in one pass
     fields = ["from", "timestamp", "type", "text", "audio_file", "version"]
-    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=S3_BUCKET):
-        for content in page["Contents"]:
-            s3_filename = content["Key"]
-            if s3_filename.endswith(".json"):
-                obj = s3.get_object(Bucket=S3_BUCKET, Key=s3_filename)
-                data = json.loads(obj["Body"].read().decode("utf-8"))
-
-                result = {
-                    "from": data.get("from"),
-                    "timestamp": data.get("timestamp"),
-                    "type": data.get("type"),
-                }
+    # Prompts are only resolved when asked for, once per distinct hash
+    include_prompts = event.get("include_prompts", False)
+    prompts: Dict[str, Any] = {}
+    if include_prompts:
+        fields.append("prompt")
+    for day in sorted(selected_days):
+        for field in selected_days[day]["fields"]:
+            if field not in fields:
+                fields.append(field)
+    # OpenAI token usage, latency and retries, rolled up over all reports
+    include_usage = event.get("include_usage", False)
+    usage = new_usage_rollup()
+    reports = 0
+
+    def rows() -> Iterator[Dict[str, Any]]:
+        nonlocal reports
+        # Fragments structured together share their window's aggregate structure
+        aggregates_seen = set()
+        for entry in iter_entries(selected_days, filters):
+            reports += 1
+            if include_prompts and "prompt" in entry:
+                reference = entry["prompt"]
+                if reference is not None and reference not in prompts:
+                    prompts[reference] = resolve_prompt(reference, inline_prompts)
+            if include_usage:
+                add_call_usage(usage, "transcription", entry["calls"]["transcription"])
+                if entry["aggregate"] not in aggregates_seen:
+                    add_call_usage(usage, "structure", entry["calls"]["structure"])
+                if entry["aggregate"]:
+                    aggregates_seen.add(entry["aggregate"])
+            yield result_row(entry, include_prompts)
 
-                if result["type"] == "text":
-                    result["text"] = data.get("text", {}).get("body")
-                    result["audio_file"] = None
-                elif result["type"] == "audio" and data.get("transcription", {}).get(
-                    "ok"
-                ):
-                    result["text"] = data.get("transcription", {}).get("text")
-                    result["audio_file"] = data.get("audio_file")
-                else:
-                    result["text"] = None
-                    result["audio_file"] = None
-
-                if data.get("structure", {}).get("ok"):
-                    structure = data["structure"]
-                    result["version"] = structure.get("version")
-                    for field, value in structure.get("result", {}).items():
-                        result[field] = value
-                        if field not in fields:
-                            fields.append(field)
-                else:
-                    result["version"] = None
-
-                results.append(result)
-
-    with io.StringIO() as file:
-        writer = csv.writer(file)
-        writer.writerow(fields)
-        for result in results:
-            writer.writerow([result.get(field) for field in fields])
-        results_csv = file.getvalue()
-
-    return {"statusCode": 200, "results_csv": results_csv, "results_json": results}
+    response: Dict[str, Any] = {"statusCode": 200, "gather": counts}
+    # {"output": "s3"} streams the CSV to S3 and returns a link to it, for
+    # results past Lambda's 6 MB response cap; rows are built as they are written
+    if event.get("output") == "s3":
+        key, count, size = export_csv(fields, rows())
+        response["results_key"] = key
+        response["results_url"] = s3.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": S3_BUCKET, "Key": key},
+            ExpiresIn=EXPORT_URL_EXPIRY,
+        )
+        response["rows"] = count
+        response["bytes"] = size
+    else:
+        results = list(rows())
+        with io.StringIO() as file:
+            write_csv(file, fields, results)
+            response["results_csv"] = file.getvalue()
+        response["results_json"] = results
+    if include_prompts:
+        response["prompts"] = prompts
+    if include_usage:
+        response["usage"] = summarize_usage(usage, reports)
+    return response
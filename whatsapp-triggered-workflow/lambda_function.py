@@ -1,28 +1,233 @@
 """Lambda entrypoint to process WhatsApp webhook messages from SNS, enrich them, and persist results."""
 
 import base64
+import copy
+import functools
+import hashlib
+import importlib
+import io
+import itertools
 import json
+import logging
+import math
 import os
 import sys
 import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    wait,
+)
 from datetime import datetime
-from typing import Any, Dict, Optional, Tuple
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
-import boto3  # type: ignore[import-not-found]
+_MODULE_STARTED = time.perf_counter()
 
+import ogg
+import triage
+
+# boto3, requests and urllib3 are imported on first use (see lazy_import)
 sys.path.append("./python-dependencies")
-import requests  # type: ignore[import-not-found,import-untyped]
+if TYPE_CHECKING:
+    import requests  # type: ignore[import-not-found,import-untyped]
 
 AWS_REGION = "us-east-1"
 S3_BUCKET = "causanatura-roc-transcriptions"
 
-socialmessaging = boto3.client("socialmessaging", region_name=AWS_REGION)  # type: ignore[assignment]
-s3 = boto3.client("s3", region_name=AWS_REGION)  # type: ignore[assignment]
+# Local stand-ins instead of AWS ("memory" or a directory); see fake_services
+FAKE_AWS_SERVICES = os.environ.get("FAKE_AWS_SERVICES", "")
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Milliseconds spent importing each lazily loaded module, for the init report
+IMPORT_TIMINGS: Dict[str, float] = {}
+_lazy_lock = threading.RLock()
+
+
+def lazy_import(name: str) -> Any:
+    """Import a module on first use and record how long the import took.
+
+    Args:
+        name: Dotted module name.
+
+    Returns:
+        The imported module.
+    """
+    with _lazy_lock:
+        if name not in IMPORT_TIMINGS:
+            started = time.perf_counter()
+            importlib.import_module(name)
+            IMPORT_TIMINGS[name] = (time.perf_counter() - started) * 1000
+        return sys.modules[name]
+
+
+class LazyClient:
+    """Stand-in for a boto3 client that is only constructed on first use.
+
+    Attribute access is forwarded to the real client. Creating clients from
+    boto3's shared default session is not thread-safe, so construction is
+    serialized.
+    """
+
+    def __init__(self, service_name: str) -> None:
+        self.service_name = service_name
+        self._client: Any = None
+
+    def get(self) -> Any:
+        """Return the real client, creating it if needed."""
+        if self._client is None:
+            with _lazy_lock:
+                if self._client is None:
+                    # fake_services mirrors boto3.client, for offline runs
+                    boto3 = lazy_import(
+                        "fake_services" if FAKE_AWS_SERVICES else "boto3"
+                    )
+                    self._client = boto3.client(
+                        self.service_name, region_name=AWS_REGION
+                    )
+        return self._client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
+
+
+socialmessaging = LazyClient("socialmessaging")
+s3 = LazyClient("s3")
+sqs = LazyClient("sqs")
 
 TIMEOUT = 20  # seconds (for each OpenAI call)
+TRANSCRIPTION_MODEL = "whisper-1"
 MODEL = "gpt-4.1"  # pick a *non-reasoning* model from https://platform.openai.com/docs/models
 TEMPERATURE = 1.0  # randomness: from 0 to 2
 
+# Messages processed at once per invocation; 1 keeps the original serial path
+MAX_IN_FLIGHT_MESSAGES = int(os.environ.get("MAX_IN_FLIGHT_MESSAGES", 1))
+
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+# Retries for throttled or failing OpenAI calls: exponential backoff (factor,
+# doubled per retry) plus random jitter, or the server's Retry-After. A retry
+# only starts if, after waiting, at least OPENAI_MIN_ATTEMPT_SECONDS remain
+# before the invocation deadline, and every attempt's timeout is clipped to the
+# time left, which keeps DEADLINE_MARGIN seconds spare to persist the message.
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 3))
+OPENAI_BACKOFF_FACTOR = 1.0  # seconds
+OPENAI_BACKOFF_JITTER = 1.0  # seconds
+OPENAI_RETRY_STATUSES = (429, 500, 502, 503, 504)
+OPENAI_MIN_ATTEMPT_SECONDS = 5.0
+DEADLINE_MARGIN = 2.0  # seconds
+
+# After OPENAI_BREAKER_THRESHOLD consecutive failed OpenAI calls (timeouts,
+# connection errors, or 429/5xx after the retries) the container stops calling
+# OpenAI for OPENAI_BREAKER_COOLDOWN seconds. Transcriptions and structures
+# that fail fast meanwhile are marked deferred, with a marker under
+# DEFERRED_PREFIX for `reprocess.py --deferred`. After the cooldown a single
+# probe call decides whether to close the breaker. 0 disables it.
+OPENAI_BREAKER_THRESHOLD = int(os.environ.get("OPENAI_BREAKER_THRESHOLD", 5))
+OPENAI_BREAKER_COOLDOWN = float(os.environ.get("OPENAI_BREAKER_COOLDOWN", 30))
+DEFERRED_PREFIX = "_deferred/"
+
+# Opt-in hedging of structuring calls: a call that has not answered within the
+# STRUCTURE_HEDGE_PERCENTILE-th percentile of recent call latencies gets an
+# identical second request, and the first answer wins. At most
+# STRUCTURE_HEDGE_MAX_RATE of calls are hedged, and only once the container
+# has seen STRUCTURE_HEDGE_MIN_SAMPLES calls. A hedge is billed for both
+# requests; only the winner's usage is recorded. 0 disables it.
+STRUCTURE_HEDGE_PERCENTILE = float(os.environ.get("STRUCTURE_HEDGE_PERCENTILE", 0))
+STRUCTURE_HEDGE_MAX_RATE = float(os.environ.get("STRUCTURE_HEDGE_MAX_RATE", 0.05))
+STRUCTURE_HEDGE_MIN_SAMPLES = 20
+STRUCTURE_HEDGE_WINDOW = 200  # latencies the percentile is taken over
+# Threads running hedged calls (primary and hedge). A call queued for a
+# thread does not count against its hedge delay, which starts once it runs.
+HEDGE_MAX_THREADS = max(32, 2 * MAX_IN_FLIGHT_MESSAGES)
+
+# Audio is buffered in memory up to this size and spilled to a temp file above it
+AUDIO_SPOOL_THRESHOLD = int(os.environ.get("AUDIO_SPOOL_THRESHOLD", 8 * 1024 * 1024))
+AUDIO_MAX_BYTES = 100 * 1024 * 1024  # largest Ogg voice note we download at all
+WHISPER_MAX_BYTES = 25 * 1024 * 1024  # Whisper rejects larger uploads
+SPLITTABLE_MEDIA_TYPE = "audio/ogg"  # other media must fit WHISPER_MAX_BYTES
+AUDIO_CHUNK_SIZE = 64 * 1024  # bytes per read when streaming audio in and out
+
+# Ogg/Opus voice notes longer than AUDIO_SPLIT_MIN_SECONDS (or larger than the
+# Whisper limit) are split at page boundaries into segments of about
+# AUDIO_SEGMENT_SECONDS, transcribed in parallel and stitched back in order
+AUDIO_SPLIT_MIN_SECONDS = float(os.environ.get("AUDIO_SPLIT_MIN_SECONDS", 120))
+AUDIO_SEGMENT_SECONDS = float(os.environ.get("AUDIO_SEGMENT_SECONDS", 60))
+AUDIO_SEGMENT_WORKERS = int(os.environ.get("AUDIO_SEGMENT_WORKERS", 4))
+
+# Structuring results are cached in-process (LRU) and under an S3 prefix
+STRUCTURE_CACHE_ENABLED = os.environ.get("STRUCTURE_CACHE_ENABLED", "1") == "1"
+STRUCTURE_CACHE_SIZE = int(os.environ.get("STRUCTURE_CACHE_SIZE", 256))
+STRUCTURE_CACHE_PREFIX = "_cache/structure/"  # "_" prefixes are skipped by gather
+
+# Whisper responses are cached in S3 by a digest of the audio bytes; entries
+# older than the TTL (seconds, 0 = never expire) are evicted when read. Entries
+# that are never read again are removed by the bucket lifecycle rule in
+# CN_DSI_S3_Lifecycle.json, whose expiration must be kept at ceil(TTL / 1 day).
+TRANSCRIPTION_CACHE_ENABLED = os.environ.get("TRANSCRIPTION_CACHE_ENABLED", "1") == "1"
+TRANSCRIPTION_CACHE_TTL = int(os.environ.get("TRANSCRIPTION_CACHE_TTL", 2592000))
+TRANSCRIPTION_CACHE_PREFIX = "_cache/transcription/"
+
+PROMPT_REGISTRY_PREFIX = "_prompts/"  # content-hashed prompt definitions
+
+# Dedup ledger: one marker per wamid, claimed before any expensive work so SNS
+# redeliveries are skipped. A claim expires when the invocation that made it
+# is ended by the runtime, or after the lease (the Lambda maximum runtime) when
+# that is unknown; expired claims belong to crashed invocations and are taken over.
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "1") == "1"
+LEDGER_PREFIX = "_ledger/"
+LEDGER_LEASE_SECONDS = 900
+
+# Texts the rule-based triage marks as not a report (greetings, thanks, emoji)
+# are not sent to the model; see triage.py
+TRIAGE_ENABLED = os.environ.get("TRIAGE_ENABLED", "1") == "1"
+
+# Consecutive fragments of one report (text, voice note, text...) are buffered
+# in a per-sender window and structured together in one call, once the sender
+# has been quiet for COALESCE_WINDOW_SECONDS or the window is
+# COALESCE_MAX_SECONDS old. 0 structures every message on its own. Windows of
+# senders who go quiet are closed by a scheduled {"coalesce_sweep": true} event.
+COALESCE_WINDOW_SECONDS = float(os.environ.get("COALESCE_WINDOW_SECONDS", 0))
+COALESCE_MAX_SECONDS = float(os.environ.get("COALESCE_MAX_SECONDS", 600))
+COALESCE_PREFIX = "_coalesce/"
+COALESCE_STATE_ATTEMPTS = 5  # conditional writes before giving up on a state
+COALESCE_FLUSH_LEASE_SECONDS = 900  # a flush this old was abandoned; redo it
+
+# SQS queues for the enrichment stages; empty runs that stage inline. With a
+# queue, the message is persisted as soon as it arrives, marked as queued, and
+# the stage runs in an invocation triggered by the queue, whose event source
+# mapping (MaximumConcurrency) caps how many run at once. Set the mappings'
+# visibility timeout above the function timeout.
+TRANSCRIBE_QUEUE_URL = os.environ.get("TRANSCRIBE_QUEUE_URL", "")
+STRUCTURE_QUEUE_URL = os.environ.get("STRUCTURE_QUEUE_URL", "")
+
+# Per-stage timings are written to stdout in CloudWatch Embedded Metric Format;
+# CloudWatch extracts them as metrics, with p50/p95/p99 statistics available
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "CN-DSI/Ingestion")
+METRICS_DIMENSIONS = [["Stage"], ["Stage", "Outcome"]]
+
+# Error codes S3 returns when a conditional put loses
+PRECONDITION_FAILED_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+
 # If you ever change the system message, increment this version number
 version = 1
 
@@ -93,6 +298,677 @@ json_schema = {
 }
 
 
+class DeadlineExceededError(Exception):
+    """Raised when an OpenAI call could not finish before the invocation deadline."""
+
+
+# Monotonic time by which OpenAI work must be done, set per invocation
+_invocation_deadline: Optional[float] = None
+# Wall-clock time at which the runtime ends this invocation, set per invocation
+_invocation_expires_at: Optional[float] = None
+
+
+def set_invocation_deadline(context: Any) -> None:
+    """Budget OpenAI calls and ledger claims against the time left.
+
+    Args:
+        context: Lambda context; without `get_remaining_time_in_millis` (e.g.
+            when run locally) calls are not budgeted and claims get the full
+            `LEDGER_LEASE_SECONDS`.
+    """
+    global _invocation_deadline, _invocation_expires_at
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        _invocation_deadline = _invocation_expires_at = None
+        return
+    remaining = context.get_remaining_time_in_millis() / 1000
+    _invocation_deadline = time.monotonic() + remaining - DEADLINE_MARGIN
+    _invocation_expires_at = time.time() + remaining
+
+
+def remaining_time() -> Optional[float]:
+    """Seconds left before the invocation deadline, or None if unbudgeted."""
+    if _invocation_deadline is None:
+        return None
+    return _invocation_deadline - time.monotonic()
+
+
+def openai_timeout() -> Any:
+    """Timeout for an OpenAI call, clipped to the deadline on every attempt.
+
+    Returns:
+        A `DeadlineTimeout` of `TIMEOUT` seconds to connect and to read.
+
+    Raises:
+        DeadlineExceededError: If too little time is left to start a call.
+    """
+    remaining = remaining_time()
+    if remaining is not None and remaining < OPENAI_MIN_ATTEMPT_SECONDS:
+        raise DeadlineExceededError(
+            f"{remaining:.1f}s left before the invocation deadline"
+        )
+    return deadline_timeout_class()(connect=TIMEOUT, read=TIMEOUT)
+
+
+@functools.lru_cache(maxsize=None)
+def deadline_timeout_class() -> type:
+    """Define `DeadlineTimeout` on first use, so urllib3 is not imported at init."""
+    Timeout = lazy_import("urllib3.util.timeout").Timeout
+
+    class DeadlineTimeout(Timeout):  # type: ignore[misc,valid-type]
+        """urllib3 timeout that is clipped to the time left before each attempt.
+
+        urllib3 clones the request's timeout for every attempt, retries
+        included, so the copy made here bounds each attempt, connect and read
+        together, by the invocation deadline.
+        """
+
+        def clone(self) -> Any:
+            remaining = remaining_time()
+            if remaining is None:
+                return super().clone()
+            # DeadlineRetry leaves at least OPENAI_MIN_ATTEMPT_SECONDS; the floor
+            # only keeps the value valid if the backoff sleep overshot
+            budget = max(remaining, 0.01)
+            return Timeout(
+                connect=min(self._connect, budget),
+                read=min(self._read, budget),
+                total=budget,
+            )
+
+    return DeadlineTimeout
+
+
+@functools.lru_cache(maxsize=None)
+def deadline_retry_class() -> type:
+    """Define `DeadlineRetry` on first use, so urllib3 is not imported at init."""
+    MaxRetryError = lazy_import("urllib3.exceptions").MaxRetryError
+    Retry = lazy_import("urllib3.util.retry").Retry
+
+    class DeadlineRetry(Retry):  # type: ignore[misc,valid-type]
+        """urllib3 retry policy that stops once the invocation deadline is near.
+
+        Before every retry it checks that, after the backoff or `Retry-After`
+        wait, at least `OPENAI_MIN_ATTEMPT_SECONDS` remain; otherwise the retries
+        are treated as exhausted.
+        """
+
+        def increment(
+            self,
+            method: Optional[str] = None,
+            url: Optional[str] = None,
+            response: Any = None,
+            error: Optional[Exception] = None,
+            _pool: Any = None,
+            _stacktrace: Any = None,
+        ) -> "DeadlineRetry":
+            retry = super().increment(method, url, response, error, _pool, _stacktrace)
+            remaining = remaining_time()
+            if remaining is None:
+                return retry
+
+            wait = None
+            if response is not None and retry.respect_retry_after_header:
+                wait = retry.get_retry_after(response)
+            if wait is None:
+                wait = retry.get_backoff_time()
+            if remaining - wait < OPENAI_MIN_ATTEMPT_SECONDS:
+                raise MaxRetryError(
+                    _pool,
+                    url,
+                    DeadlineExceededError(
+                        f"retry after {wait:.1f}s would not finish in the "
+                        f"{remaining:.1f}s left"
+                    ),
+                )
+            return retry
+
+    return DeadlineRetry
+
+
+def build_openai_session(pool_size: int) -> "requests.Session":
+    """Build a keep-alive session for the OpenAI API.
+
+    Throttled (429) and server error responses, and connection or read errors,
+    are retried with `DeadlineRetry`. Responses still failing after the last
+    retry are returned to the caller as-is.
+
+    Args:
+        pool_size: Connections kept open to the API host; match it to the
+            number of calls that can be in flight at once.
+
+    Returns:
+        Session whose adapter pools connections across calls.
+    """
+    requests = lazy_import("requests")
+    HTTPAdapter = lazy_import("requests.adapters").HTTPAdapter
+    session = requests.Session()
+    retry = deadline_retry_class()(
+        total=OPENAI_MAX_RETRIES,
+        allowed_methods=frozenset({"POST"}),
+        status_forcelist=OPENAI_RETRY_STATUSES,
+        backoff_factor=OPENAI_BACKOFF_FACTOR,
+        backoff_jitter=OPENAI_BACKOFF_JITTER,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Built on the first OpenAI call, then kept for the container's lifetime so
+# warm invocations reuse open TLS connections
+_openai_session: Optional["requests.Session"] = None
+
+
+def get_openai_session() -> "requests.Session":
+    """Return the container's OpenAI session, building it on first use."""
+    global _openai_session
+    if _openai_session is None:
+        with _lazy_lock:
+            if _openai_session is None:
+                _openai_session = build_openai_session(
+                    MAX_IN_FLIGHT_MESSAGES * AUDIO_SEGMENT_WORKERS
+                )
+    return _openai_session
+
+
+def openai_connection_stats() -> Dict[str, int]:
+    """Report how many OpenAI requests reused an already open connection.
+
+    Counters are cumulative for the lifetime of the container.
+
+    Returns:
+        Dict with the requests sent, connections opened and connections reused.
+    """
+    requests_sent = connections_opened = 0
+    adapters: List[Any] = (
+        list(_openai_session.adapters.values()) if _openai_session else []
+    )
+    for adapter in set(adapters):
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            requests_sent += pool.num_requests
+            connections_opened += pool.num_connections
+    return {
+        "requests": requests_sent,
+        "connections_opened": connections_opened,
+        "connections_reused": max(requests_sent - connections_opened, 0),
+    }
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling OpenAI while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker shared by the threads of a container.
+
+    Closed, calls go through and failures are counted; `threshold` failures in
+    a row open it. Open, calls fail fast with `CircuitOpenError` until
+    `cooldown` seconds have passed. It is then half-open and lets one probe
+    call through at a time: a success closes it, a failure opens it again for
+    another cooldown.
+
+    Args:
+        threshold: Consecutive failures that open the breaker; 0 disables it.
+        cooldown: Seconds the breaker stays open before probing.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """Let a call through, or fail it fast.
+
+        Raises:
+            CircuitOpenError: If the breaker is open, or half-open with its
+                probe still in flight.
+        """
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                waited = time.monotonic() - self.opened_at
+                if waited < self.cooldown:
+                    raise CircuitOpenError(
+                        f"OpenAI circuit breaker open for another "
+                        f"{self.cooldown - waited:.0f}s"
+                    )
+                self.state = self.HALF_OPEN
+            if self._probing:
+                raise CircuitOpenError("OpenAI circuit breaker waiting on its probe")
+            self._probing = True
+
+    def record_success(self) -> None:
+        """Count a call that reached OpenAI and got a non-failure answer."""
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                logger.info("OpenAI circuit breaker closed")
+                self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        """Count a call that timed out, could not connect, or was throttled."""
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.threshold <= 0 or self.state == self.OPEN:
+                return
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                logger.warning(
+                    "OpenAI circuit breaker opened after %d consecutive failures",
+                    self.failures,
+                )
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+# Shared by every OpenAI call in the container, across warm invocations
+openai_breaker = CircuitBreaker(OPENAI_BREAKER_THRESHOLD, OPENAI_BREAKER_COOLDOWN)
+
+
+def post_openai(path: str, **kwargs: Any) -> "requests.Response":
+    """POST to the OpenAI API through the container's session and breaker.
+
+    Exceptions, and responses still throttled or failing after the session's
+    retries, count as failures for the breaker.
+
+    Args:
+        path: API path under `OPENAI_BASE_URL`, e.g. "/chat/completions".
+        **kwargs: Passed on to `requests.Session.post`.
+
+    Returns:
+        The final response.
+
+    Raises:
+        CircuitOpenError: If the breaker is open; nothing is sent.
+        DeadlineExceededError: If too little time is left to start a call.
+    """
+    timeout = openai_timeout()
+    openai_breaker.before_call()
+    try:
+        response = get_openai_session().post(
+            f"{OPENAI_BASE_URL}{path}", timeout=timeout, **kwargs
+        )
+    except BaseException:
+        openai_breaker.record_failure()
+        raise
+    if response.status_code in OPENAI_RETRY_STATUSES:
+        openai_breaker.record_failure()
+    else:
+        openai_breaker.record_success()
+    return response
+
+
+class RequestHedger:
+    """Decides when to hedge a call, from the latencies of recent calls.
+
+    The hedge delay is the `percentile`-th percentile of the last `window`
+    successful call latencies. Hedging waits for `min_samples` of them, and
+    at most `max_rate` of all calls are hedged. Counters are cumulative for
+    the lifetime of the container.
+    """
+
+    def __init__(
+        self, percentile: float, max_rate: float, min_samples: int, window: int
+    ) -> None:
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.fired = 0
+        self.won = 0
+        self._lock = threading.Lock()
+
+    def record_latency(self, seconds: float) -> None:
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def delay(self) -> Optional[float]:
+        """Count a new call and return its hedge delay, or None to not hedge."""
+        with self._lock:
+            self.calls += 1
+            if self.percentile <= 0 or len(self.latencies) < self.min_samples:
+                return None
+            ordered = sorted(self.latencies)
+            rank = math.ceil(self.percentile / 100 * len(ordered))
+            return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+    def try_fire(self) -> bool:
+        """Take a hedge from the budget; False if that would exceed the rate."""
+        with self._lock:
+            if self.fired + 1 > self.max_rate * self.calls:
+                return False
+            self.fired += 1
+            return True
+
+    def record_win(self) -> None:
+        with self._lock:
+            self.won += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": self.calls, "fired": self.fired, "won": self.won}
+
+
+structure_hedger = RequestHedger(
+    STRUCTURE_HEDGE_PERCENTILE,
+    STRUCTURE_HEDGE_MAX_RATE,
+    STRUCTURE_HEDGE_MIN_SAMPLES,
+    STRUCTURE_HEDGE_WINDOW,
+)
+
+# Runs hedged calls; threads are only started when needed
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _lazy_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=HEDGE_MAX_THREADS, thread_name_prefix="hedge"
+                )
+    return _hedge_executor
+
+
+def answered(future: Future) -> bool:
+    """Whether a finished call future holds a non-error response."""
+    return future.exception() is None and future.result().status_code < 400
+
+
+def post_hedged(
+    hedger: RequestHedger, path: str, **kwargs: Any
+) -> Tuple["requests.Response", Optional[Dict[str, Any]]]:
+    """POST through `post_openai`, hedging the call if it is slower than usual.
+
+    Once the hedger's delay has passed without an answer, an identical second
+    request is sent and the first successful response is used. The other one
+    cannot be cancelled mid-flight; it is left to finish and discarded.
+
+    Args:
+        hedger: Decides the delay and keeps the hedge budget and counters.
+        path: API path under `OPENAI_BASE_URL`.
+        **kwargs: Passed on to `requests.Session.post`.
+
+    Returns:
+        The response used, and None if no hedge was sent, else the hedge
+        `delay_ms` and whether it `won`. If both requests fail, the first
+        request's outcome is returned or raised.
+    """
+    delay = hedger.delay()
+    started = time.perf_counter()
+
+    if delay is None:
+        response = post_openai(path, **kwargs)
+        if response.status_code < 400:
+            hedger.record_latency(time.perf_counter() - started)
+        return response, None
+
+    # The primary may wait for a free thread when the pool is shared by many
+    # calls; its delay and latency are timed from when it starts running.
+    running = threading.Event()
+
+    def run_primary() -> "requests.Response":
+        nonlocal started
+        started = time.perf_counter()
+        running.set()
+        return post_openai(path, **kwargs)
+
+    def record(future: Future) -> None:
+        if answered(future):
+            hedger.record_latency(time.perf_counter() - started)
+
+    executor = get_hedge_executor()
+    primary = executor.submit(run_primary)
+    primary.add_done_callback(record)
+    running.wait()
+    try:
+        return (
+            primary.result(timeout=max(delay - (time.perf_counter() - started), 0)),
+            None,
+        )
+    except FutureTimeoutError:
+        pass
+    if not hedger.try_fire():
+        return primary.result(), None
+
+    hedge = executor.submit(post_openai, path, **kwargs)
+    info = {"delay_ms": round(delay * 1000, 1), "won": False}
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in (primary, hedge):
+            if future in done and answered(future):
+                if future is hedge:
+                    hedger.record_win()
+                    info["won"] = True
+                return future.result(), info
+    return primary.result(), info
+
+
+_metrics_lock = threading.Lock()
+
+
+def emit_stage_metrics(
+    stage: str,
+    latency_ms: float,
+    outcome: str,
+    payload_bytes: Optional[int],
+    properties: Dict[str, Any],
+) -> None:
+    """Write one stage measurement to stdout as a CloudWatch EMF log line.
+
+    Args:
+        stage: Pipeline stage name (the `Stage` dimension).
+        latency_ms: Time spent in the stage.
+        outcome: "ok", "error", "cached", "deferred" or "skipped" (the
+            `Outcome` dimension).
+        payload_bytes: Bytes the stage handled, if meaningful for it.
+        properties: Extra fields logged alongside, not turned into metrics.
+    """
+    metrics = [{"Name": "Latency", "Unit": "Milliseconds"}]
+    record = {
+        **properties,
+        "Stage": stage,
+        "Outcome": outcome,
+        "Latency": round(latency_ms, 3),
+    }
+    if payload_bytes is not None:
+        metrics.append({"Name": "PayloadBytes", "Unit": "Bytes"})
+        record["PayloadBytes"] = payload_bytes
+    record["_aws"] = {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [
+            {
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": METRICS_DIMENSIONS,
+                "Metrics": metrics,
+            }
+        ],
+    }
+    # Not through `logger`: EMF lines must reach the log stream as bare JSON
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _metrics_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+class StageTimer:
+    """Context manager timing one pipeline stage and emitting it as EMF.
+
+    The outcome is "error" if the block raises; callers can otherwise set
+    `outcome` and `payload_bytes` on the timer before the block ends.
+    """
+
+    __slots__ = ("stage", "properties", "outcome", "payload_bytes", "_started")
+
+    def __init__(self, stage: str, properties: Dict[str, Any]) -> None:
+        self.stage = stage
+        self.properties = properties
+        self.outcome = "ok"
+        self.payload_bytes: Optional[int] = None
+        self._started = 0.0
+
+    def __enter__(self) -> "StageTimer":
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        latency_ms = (time.perf_counter() - self._started) * 1000
+        if exc_type is not None:
+            self.outcome = "error"
+        try:
+            emit_stage_metrics(
+                self.stage,
+                latency_ms,
+                self.outcome,
+                self.payload_bytes,
+                self.properties,
+            )
+        except Exception:
+            logger.warning("Could not emit metrics for %s", self.stage, exc_info=True)
+
+
+class NullStageTimer:
+    """Stand-in for `StageTimer` when metrics are disabled; shared and inert."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "NullStageTimer":
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, traceback: Any) -> None:
+        return None
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        pass
+
+
+NULL_STAGE_TIMER = NullStageTimer()
+
+
+def stage_timer(stage: str, **properties: Any) -> Any:
+    """Time a pipeline stage: `with stage_timer("gpt") as timer: ...`.
+
+    With METRICS_ENABLED off this returns a shared no-op timer, so the
+    instrumentation costs one function call per stage.
+
+    Args:
+        stage: Pipeline stage name.
+        **properties: Extra fields logged with the measurement.
+
+    Returns:
+        A `StageTimer`, or `NULL_STAGE_TIMER` when metrics are disabled.
+    """
+    if not METRICS_ENABLED:
+        return NULL_STAGE_TIMER
+    return StageTimer(stage, properties)
+
+
+def payload_outcome(payload: Optional[Dict[str, Any]]) -> str:
+    """Outcome dimension for a transcription or structure payload."""
+    if payload is None:
+        return "skipped"
+    if (payload.get("cache") or {}).get("hit"):
+        return "cached"
+    if payload.get("deferred"):
+        return "deferred"
+    return "ok" if payload.get("ok") else "error"
+
+
+def openai_call_info(
+    response: Optional["requests.Response"], started: float, model: str
+) -> Dict[str, Any]:
+    """Describe one OpenAI call for the persisted payload.
+
+    Args:
+        response: Final response, or None if no response was received.
+        started: `time.perf_counter()` taken before the call.
+        model: Model requested; replaced by the served model if reported.
+
+    Returns:
+        Dict with the model, token/duration `usage` (as reported by OpenAI),
+        wall-clock latency including retries, and the number of retries.
+    """
+    info: Dict[str, Any] = {
+        "model": model,
+        "usage": None,
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+        "retries": None,
+    }
+    if response is None:
+        return info
+    retry_state = getattr(response.raw, "retries", None)
+    info["retries"] = len(retry_state.history) if retry_state is not None else 0
+    try:
+        body = response.json()
+    except ValueError:
+        return info
+    if isinstance(body, dict):
+        info["model"] = body.get("model") or model
+        info["usage"] = body.get("usage")
+    return info
+
+
+def merge_call_info(calls: List[Dict[str, Any]], latency_ms: float) -> Dict[str, Any]:
+    """Combine the call info of concurrent calls (e.g. audio segments).
+
+    Numeric usage fields and retries are summed; latency is the wall-clock
+    time of the whole batch.
+    """
+    usage: Dict[str, Any] = {}
+    for call in calls:
+        for field, value in (call.get("usage") or {}).items():
+            if isinstance(value, (int, float)):
+                usage[field] = usage.get(field, 0) + value
+            else:
+                usage.setdefault(field, value)
+    return {
+        "model": calls[0]["model"] if calls else None,
+        "usage": usage or None,
+        "latency_ms": round(latency_ms, 1),
+        "retries": sum(call.get("retries") or 0 for call in calls),
+        "calls": len(calls),
+    }
+
+
+def prompt_hash(definition: Dict[str, Any]) -> str:
+    """Content hash identifying a prompt definition in the registry."""
+    return hashlib.sha256(
+        json.dumps(definition, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+PROMPT_DEFINITION = {
+    "version": version,
+    "system_message": system_message,
+    "json_schema": json_schema,
+}
+PROMPT_HASH = prompt_hash(PROMPT_DEFINITION)
+
+_prompt_registered = threading.Event()
+
+
 def parse_sns_record(record: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
     """Extract the WhatsApp webhook payload from an SNS record.
 
@@ -138,9 +1014,12 @@ def normalize_wamid(wamid: str) -> str:
     """
     if wamid.startswith("wamid."):
         wamid = wamid[6:]
+    # A digest rather than hash(), which is randomized per process, so the
+    # same wamid maps to the same S3 key after every cold start. URL-safe base64
+    # keeps "/" out of the id.
     return (
-        base64.b64encode(
-            hash(base64.b64decode(wamid)).to_bytes(8, byteorder="big", signed=True)
+        base64.urlsafe_b64encode(
+            hashlib.blake2b(wamid.encode("utf-8"), digest_size=8).digest()
         )
         .decode()
         .rstrip("=")
@@ -181,94 +1060,624 @@ def parse_timestamp(message: Dict[str, Any]) -> Optional[int]:
         return None
 
 
-def request_transcription(local_filename: str) -> Tuple[Optional[str], Dict[str, Any]]:
-    """Send audio to OpenAI Whisper and return the transcription payload.
-
-    Args:
-        local_filename: Path to the audio file on disk.
+class MultipartFileBody:
+    """Streaming multipart/form-data body with plain fields and one file part.
 
-    Returns:
-        Tuple of the transcription text (or None) and the transcription payload.
+    `requests` reads the whole file into memory when it encodes `files=`, so
+    this wrapper is handed over as `data=` instead: it yields the fields, the
+    file in chunks and the closing boundary, and reports its total length so
+    the request still goes out with a Content-Length. It supports `seek` and
+    `tell` so urllib3 can rewind it if a request has to be re-sent.
     """
-    with open(local_filename, "rb") as file:
-        try:
-            transcription = requests.post(
-                "https://api.openai.com/v1/audio/transcriptions",
-                timeout=TIMEOUT,
-                headers={"Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"},
-                files={"file": file},
-                data={"model": "whisper-1", "response_format": "json"},
-            ).json()
-            transcription["ok"] = True
-            return transcription.get("text"), transcription
-        except Exception as err:
-            transcription = {
-                "ok": False,
-                "error": type(err).__name__,
-                "message": str(err),
-            }
-            return None, transcription
 
+    def __init__(
+        self,
+        fields: Dict[str, str],
+        file_field: str,
+        filename: str,
+        file_content_type: str,
+        fileobj: IO[bytes],
+    ) -> None:
+        self.boundary = os.urandom(16).hex()
+        head = "".join(
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f"{value}\r\n"
+            for name, value in fields.items()
+        )
+        head += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f"Content-Type: {file_content_type}\r\n\r\n"
+        )
+        self._head = head.encode()
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._file = fileobj
+        self._file.seek(0, os.SEEK_END)
+        self._file_size = self._file.tell()
+        self._position = 0
 
-def handle_audio_message(
-    message: Dict[str, Any], orig_phone_id: str, s3_dir: str
-) -> Optional[str]:
-    """Download audio from WhatsApp, send to Whisper, and attach results to the message.
+    @property
+    def content_type(self) -> str:
+        """Value for the request's Content-Type header."""
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            chunk = self.read(AUDIO_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self)
+        self._position = min(max(offset, 0), len(self))
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self) - self._position
+        chunks = []
+        while size > 0 and self._position < len(self):
+            file_start = len(self._head)
+            tail_start = file_start + self._file_size
+            if self._position < file_start:
+                chunk = self._head[self._position : self._position + size]
+            elif self._position < tail_start:
+                self._file.seek(self._position - file_start)
+                chunk = self._file.read(min(size, tail_start - self._position))
+                if not chunk:
+                    raise IOError("audio buffer is shorter than its reported size")
+            else:
+                offset = self._position - tail_start
+                chunk = self._tail[offset : offset + size]
+            chunks.append(chunk)
+            self._position += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+
+def is_splittable(media_type: str) -> bool:
+    """Whether audio of this MIME type can be split into segments for Whisper."""
+    return media_type.split(";")[0].strip() == SPLITTABLE_MEDIA_TYPE
+
+
+def fetch_audio(s3_filename: str, media_type: str) -> Tuple[IO[bytes], str]:
+    """Stream an audio object from S3 into a size-bounded spooled buffer.
+
+    The object stays in memory up to `AUDIO_SPOOL_THRESHOLD` bytes and only
+    spills to a temporary file above it, so typical voice notes never touch
+    the disk. The SHA-256 of the bytes is computed on the way in.
 
     Args:
-        message: WhatsApp message containing audio metadata.
-        orig_phone_id: Phone id used to fetch media from WhatsApp.
-        s3_dir: S3 directory where media is stored.
+        s3_filename: Key of the audio object in the bucket.
+        media_type: MIME type of the audio; only Ogg voice notes, which can be
+            split, may exceed `WHISPER_MAX_BYTES`.
 
     Returns:
-        Transcribed message text, or None if unavailable.
-    """
-    audio = message["audio"]
-    media_type = audio.get("mime_type")
-    media_id = audio.get("id")
-
-    result = socialmessaging.get_whatsapp_message_media(
-        mediaId=media_id,
-        originationPhoneNumberId=orig_phone_id,
-        destinationS3File={
-            "bucketName": S3_BUCKET,
-            "key": f"{s3_dir}/",
-        },
-    )
-    if result.get("ResponseMetadata", {}).get("HTTPStatusCode") != 200:
-        return None
+        Buffer positioned at the start of the audio (the caller closes it)
+        and the hex digest of its contents.
 
-    with tempfile.TemporaryDirectory() as td:
-        ext_suffix = media_type.split(";")[0].split("/")[-1]
-        s3_filename = f"{s3_dir}/{media_id}.{ext_suffix}"
-        local_filename = os.path.join(td, f"{media_id}.{ext_suffix}")
-        s3.download_file(S3_BUCKET, s3_filename, local_filename)
-        message_text, transcription = request_transcription(local_filename)
+    Raises:
+        ValueError: If the object is larger than `AUDIO_MAX_BYTES`, or than
+            `WHISPER_MAX_BYTES` for media that cannot be split.
+    """
+    max_bytes = AUDIO_MAX_BYTES if is_splittable(media_type) else WHISPER_MAX_BYTES
+    obj = s3.get_object(Bucket=S3_BUCKET, Key=s3_filename)
+    if obj.get("ContentLength", 0) > max_bytes:
+        obj["Body"].close()
+        raise ValueError(
+            f"{s3_filename} is {obj['ContentLength']} bytes, "
+            f"above the {max_bytes} byte limit"
+        )
 
-    message["audio_file"] = f"s3://{S3_BUCKET}/{s3_filename}"
-    message["transcription"] = transcription
-    return message_text
+    buffer = tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_THRESHOLD)
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in obj["Body"].iter_chunks(AUDIO_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            buffer.close()
+            obj["Body"].close()
+            raise ValueError(f"{s3_filename} exceeds the {max_bytes} byte limit")
+        buffer.write(chunk)
+        digest.update(chunk)
+    buffer.seek(0)
+    return buffer, digest.hexdigest()  # type: ignore[return-value]
 
 
-def build_structure_from_text(message_text: str) -> Dict[str, Any]:
-    """Call ChatGPT to convert free text into the target JSON structure.
+def request_transcription(
+    audio: IO[bytes], filename: str, media_type: str
+) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Send audio to OpenAI Whisper and return the transcription payload.
 
     Args:
-        message_text: Free-text content from the WhatsApp message.
+        audio: Readable, seekable buffer holding the audio.
+        filename: File name reported to Whisper; its extension sets the format.
+        media_type: MIME type of the audio.
 
     Returns:
-        Structure payload enriched with metadata and ok/error state.
+        Tuple of the transcription text (or None) and the transcription payload.
     """
+    started = time.perf_counter()
+    response = None
     try:
-        response = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            timeout=TIMEOUT,
+        body = MultipartFileBody(
+            {"model": TRANSCRIPTION_MODEL, "response_format": "json"},
+            "file",
+            filename,
+            media_type,
+            audio,
+        )
+        response = post_openai(
+            "/audio/transcriptions",
             headers={
                 "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}",
-                "Content-Type": "application/json",
+                "Content-Type": body.content_type,
             },
-            json={
-                "model": MODEL,
+            data=body,
+        )
+        response.raise_for_status()
+        transcription = response.json()
+        transcription.pop("usage", None)
+        transcription["ok"] = True
+        message_text = transcription.get("text")
+    except Exception as err:
+        transcription = {
+            "ok": False,
+            "error": type(err).__name__,
+            "message": str(err),
+        }
+        if isinstance(err, CircuitOpenError):
+            transcription["deferred"] = True
+        message_text = None
+    transcription["openai"] = openai_call_info(response, started, TRANSCRIPTION_MODEL)
+    return message_text, transcription
+
+
+def split_long_audio(
+    audio: IO[bytes], media_type: str
+) -> Optional[Iterator[IO[bytes]]]:
+    """Split a long Ogg/Opus voice note into standalone segments.
+
+    The duration comes from the Ogg headers (first and last page), so short
+    notes are never read in full here. Long ones are split page by page
+    straight from `audio`, and each segment is written to its own spooled
+    buffer as it is needed, so the note is never held in memory whole.
+
+    Args:
+        audio: Readable, seekable buffer holding the audio. It is rewound if
+            None is returned; otherwise the segments are read from it.
+        media_type: MIME type of the audio.
+
+    Returns:
+        Segment buffers in playback order, each closed by the caller, or None
+        if the audio should be sent whole.
+    """
+    if not is_splittable(media_type):
+        return None
+    try:
+        audio.seek(0, os.SEEK_END)
+        size = audio.tell()
+        duration = ogg.duration_seconds(audio)
+        if duration < AUDIO_SPLIT_MIN_SECONDS and size <= WHISPER_MAX_BYTES:
+            return None
+        segments = ogg.split_opus(
+            audio,
+            AUDIO_SEGMENT_SECONDS,
+            WHISPER_MAX_BYTES,
+            lambda: tempfile.SpooledTemporaryFile(max_size=AUDIO_SPOOL_THRESHOLD),
+        )
+        first = next(segments)
+        second = next(segments, None)
+    except ValueError:
+        logger.warning(
+            "Could not split %s audio, sending it whole", media_type, exc_info=True
+        )
+        audio.seek(0)
+        return None
+    if second is None:
+        first.close()
+        audio.seek(0)
+        return None
+    return itertools.chain((first, second), segments)
+
+
+def request_segmented_transcription(
+    segments: Iterator[IO[bytes]], filename: str, media_type: str
+) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Transcribe audio segments concurrently and stitch the texts in order.
+
+    At most `AUDIO_SEGMENT_WORKERS` segments are taken from `segments` ahead
+    of their transcription finishing, and each is closed once transcribed.
+
+    Args:
+        segments: Standalone audio segment buffers in playback order.
+        filename: File name reported to Whisper; its extension sets the format.
+        media_type: MIME type of the audio.
+
+    Returns:
+        Tuple of the joined text (or None if any segment failed, or the audio
+        could not be split to the end) and the transcription payload, which
+        keeps every segment's own payload.
+    """
+
+    def transcribe(segment: IO[bytes]) -> Tuple[Optional[str], Dict[str, Any]]:
+        with segment:
+            return request_transcription(segment, filename, media_type)
+
+    started = time.perf_counter()
+    futures: List[Future] = []
+    split_error: Optional[ValueError] = None
+    slots = threading.BoundedSemaphore(AUDIO_SEGMENT_WORKERS)
+    with ThreadPoolExecutor(max_workers=AUDIO_SEGMENT_WORKERS) as executor:
+        while True:
+            slots.acquire()
+            try:
+                segment = next(segments, None)
+            except ValueError as err:
+                split_error = err
+                segment = None
+            if segment is None:
+                slots.release()
+                break
+            future = executor.submit(transcribe, segment)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+    results = [future.result() for future in futures]
+
+    payloads = [payload for _, payload in results]
+    openai = merge_call_info(
+        [payload["openai"] for payload in payloads],
+        (time.perf_counter() - started) * 1000,
+    )
+    failed = [payload for payload in payloads if not payload["ok"]]
+    if split_error is not None:
+        failed.insert(
+            0,
+            {
+                "ok": False,
+                "error": type(split_error).__name__,
+                "message": str(split_error),
+            },
+        )
+    if failed:
+        transcription = {
+            "ok": False,
+            "error": failed[0]["error"],
+            "message": failed[0]["message"],
+            "segments": payloads,
+            "openai": openai,
+        }
+        if any(payload.get("deferred") for payload in failed):
+            transcription["deferred"] = True
+        return None, transcription
+    text = " ".join(text.strip() for text, _ in results if text)
+    return text, {"text": text, "ok": True, "segments": payloads, "openai": openai}
+
+
+def request_audio_transcription(
+    audio: IO[bytes], filename: str, media_type: str
+) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Transcribe audio in one Whisper call, or in parallel segments if it is long.
+
+    Args:
+        audio: Readable, seekable buffer holding the audio.
+        filename: File name reported to Whisper; its extension sets the format.
+        media_type: MIME type of the audio.
+
+    Returns:
+        Tuple of the transcription text (or None) and the transcription payload.
+    """
+    segments = split_long_audio(audio, media_type)
+    if segments is None:
+        return request_transcription(audio, filename, media_type)
+    try:
+        return request_segmented_transcription(segments, filename, media_type)
+    finally:
+        audio.seek(0)
+
+
+def transcription_cache_key(audio_digest: str) -> str:
+    """S3 key of the cached Whisper response for an audio digest."""
+    return f"{TRANSCRIPTION_CACHE_PREFIX}{TRANSCRIPTION_MODEL}/{audio_digest}.json"
+
+
+def lookup_transcription_cache(audio_digest: str) -> Optional[Dict[str, Any]]:
+    """Return the cached Whisper response for this audio, if still fresh.
+
+    Entries older than `TRANSCRIPTION_CACHE_TTL` are deleted and reported as
+    misses; the bucket lifecycle rule expires those that are never read.
+    Cache errors are logged and treated as misses.
+
+    Args:
+        audio_digest: SHA-256 hex digest of the audio bytes.
+
+    Returns:
+        The cached transcription payload, or None on a miss.
+    """
+    key = transcription_cache_key(audio_digest)
+    try:
+        cached = read_s3_json(key)
+        if cached is None:
+            return None
+        age = time.time() - cached.get("cached_at", 0)
+        if TRANSCRIPTION_CACHE_TTL and age > TRANSCRIPTION_CACHE_TTL:
+            s3.delete_object(Bucket=S3_BUCKET, Key=key)
+            return None
+    except Exception:
+        logger.warning("Transcription cache read failed for %s", key, exc_info=True)
+        return None
+    return cached["transcription"]
+
+
+def store_transcription_cache(audio_digest: str, transcription: Dict[str, Any]) -> None:
+    """Store a successful Whisper response under the audio digest.
+
+    Args:
+        audio_digest: SHA-256 hex digest of the audio bytes.
+        transcription: Transcription payload returned by Whisper.
+    """
+    key = transcription_cache_key(audio_digest)
+    try:
+        write_s3_json(key, {"cached_at": time.time(), "transcription": transcription})
+    except Exception:
+        logger.warning("Transcription cache write failed for %s", key, exc_info=True)
+
+
+def transcribe_audio(
+    audio: IO[bytes], audio_digest: str, filename: str, media_type: str
+) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Transcribe audio, serving repeated (e.g. forwarded) voice notes from the cache.
+
+    Args:
+        audio: Readable, seekable buffer holding the audio.
+        audio_digest: SHA-256 hex digest of the audio bytes.
+        filename: File name reported to Whisper; its extension sets the format.
+        media_type: MIME type of the audio.
+
+    Returns:
+        Tuple of the transcription text (or None) and the transcription payload.
+    """
+    if not TRANSCRIPTION_CACHE_ENABLED:
+        return request_audio_transcription(audio, filename, media_type)
+
+    transcription = lookup_transcription_cache(audio_digest)
+    if transcription is not None:
+        transcription["cache"] = {"hit": True, "key": audio_digest}
+        return transcription.get("text"), transcription
+
+    message_text, transcription = request_audio_transcription(
+        audio, filename, media_type
+    )
+    if transcription["ok"]:
+        store_transcription_cache(audio_digest, transcription)
+    transcription["cache"] = {"hit": False, "key": audio_digest}
+    return message_text, transcription
+
+
+def handle_audio_message(
+    message: Dict[str, Any], orig_phone_id: str, s3_dir: str
+) -> Optional[str]:
+    """Download audio from WhatsApp, send to Whisper, and attach results to the message.
+
+    Args:
+        message: WhatsApp message containing audio metadata.
+        orig_phone_id: Phone id used to fetch media from WhatsApp.
+        s3_dir: S3 directory where media is stored.
+
+    Returns:
+        Transcribed message text, or None if unavailable.
+    """
+    audio = message["audio"]
+    media_type = audio.get("mime_type")
+    media_id = audio.get("id")
+
+    with stage_timer("media_fetch") as timer:
+        result = socialmessaging.get_whatsapp_message_media(
+            mediaId=media_id,
+            originationPhoneNumberId=orig_phone_id,
+            destinationS3File={
+                "bucketName": S3_BUCKET,
+                "key": f"{s3_dir}/",
+            },
+        )
+        fetched = result.get("ResponseMetadata", {}).get("HTTPStatusCode") == 200
+        if not fetched:
+            timer.outcome = "error"
+    if not fetched:
+        return None
+
+    ext_suffix = media_type.split(";")[0].split("/")[-1]
+    filename = f"{media_id}.{ext_suffix}"
+    s3_filename = f"{s3_dir}/{filename}"
+    try:
+        with stage_timer("s3_download") as timer:
+            buffer, audio_digest = fetch_audio(s3_filename, media_type)
+            audio_size = buffer.seek(0, io.SEEK_END)
+            buffer.seek(0)
+            timer.payload_bytes = audio_size
+    except ValueError as err:
+        message_text = None
+        transcription = {
+            "ok": False,
+            "error": type(err).__name__,
+            "message": str(err),
+        }
+    else:
+        with buffer, stage_timer("whisper") as timer:
+            message_text, transcription = transcribe_audio(
+                buffer, audio_digest, filename, media_type
+            )
+            timer.outcome = payload_outcome(transcription)
+            timer.payload_bytes = audio_size
+
+    message["audio_file"] = f"s3://{S3_BUCKET}/{s3_filename}"
+    message["transcription"] = transcription
+    return message_text
+
+
+def s3_error_code(err: Exception) -> Optional[str]:
+    """Return the S3 error code carried by a botocore ClientError, if any."""
+    return getattr(err, "response", {}).get("Error", {}).get("Code")
+
+
+def read_s3_json(key: str) -> Optional[Dict[str, Any]]:
+    """Read a JSON object from the bucket.
+
+    Args:
+        key: Object key.
+
+    Returns:
+        The decoded object, or None if the key does not exist.
+    """
+    try:
+        obj = s3.get_object(Bucket=S3_BUCKET, Key=key)
+    except Exception as err:
+        if s3_error_code(err) in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(obj["Body"].read().decode("utf-8"))
+
+
+def write_s3_json(key: str, payload: Dict[str, Any], **kwargs: Any) -> None:
+    """Write a JSON object to the bucket; extra kwargs go to `put_object`."""
+    s3.put_object(
+        Bucket=S3_BUCKET,
+        Key=key,
+        Body=json.dumps(payload).encode("utf-8"),
+        ContentType="application/json",
+        **kwargs,
+    )
+
+
+class LRUCache:
+    """Small thread-safe LRU mapping shared by the worker threads of a container.
+
+    Values are deep-copied in and out so callers can mutate what they get.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._items: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return copy.deepcopy(self._items[key])
+
+    def put(self, key: str, value: Any) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = copy.deepcopy(value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+structure_cache = LRUCache(STRUCTURE_CACHE_SIZE)
+
+
+def normalize_report_text(message_text: str) -> str:
+    """Normalize report text so trivially different copies share a cache key."""
+    return " ".join(unicodedata.normalize("NFC", message_text).split())
+
+
+def structure_cache_key(message_text: str) -> str:
+    """Build the content-addressed cache key for a structuring request.
+
+    Args:
+        message_text: Free-text content from the WhatsApp message.
+
+    Returns:
+        Hex digest over the prompt version, model, temperature and text hash.
+    """
+    text_hash = hashlib.sha256(
+        normalize_report_text(message_text).encode("utf-8")
+    ).hexdigest()
+    return hashlib.sha256(
+        json.dumps([version, MODEL, TEMPERATURE, text_hash]).encode("utf-8")
+    ).hexdigest()
+
+
+def lookup_structure_cache(cache_key: str) -> Optional[Tuple[Dict[str, Any], str]]:
+    """Look a structuring result up in the memory tier, then the S3 tier.
+
+    Cache errors are logged and treated as misses so they never fail a message.
+
+    Args:
+        cache_key: Key from `structure_cache_key`.
+
+    Returns:
+        Tuple of the cached result and the tier it came from, or None on a miss.
+    """
+    result = structure_cache.get(cache_key)
+    if result is not None:
+        return result, "memory"
+    try:
+        cached = read_s3_json(f"{STRUCTURE_CACHE_PREFIX}{cache_key}.json")
+    except Exception:
+        logger.warning("Structure cache read failed for %s", cache_key, exc_info=True)
+        return None
+    if cached is None:
+        return None
+    structure_cache.put(cache_key, cached["result"])
+    return cached["result"], "s3"
+
+
+def store_structure_cache(cache_key: str, result: Dict[str, Any]) -> None:
+    """Store a successful structuring result in both cache tiers.
+
+    Args:
+        cache_key: Key from `structure_cache_key`.
+        result: Structured result returned by ChatGPT.
+    """
+    structure_cache.put(cache_key, result)
+    try:
+        write_s3_json(
+            f"{STRUCTURE_CACHE_PREFIX}{cache_key}.json",
+            {"version": version, "model": MODEL, "result": result},
+        )
+    except Exception:
+        logger.warning("Structure cache write failed for %s", cache_key, exc_info=True)
+
+
+def request_structure(message_text: str) -> Dict[str, Any]:
+    """Call ChatGPT to convert free text into the target JSON structure.
+
+    Args:
+        message_text: Free-text content from the WhatsApp message.
+
+    Returns:
+        Structure payload with the result and ok/error state, and the call's
+        model, token usage, latency and retries under "openai".
+    """
+    started = time.perf_counter()
+    response = None
+    structure: Dict[str, Any]
+    try:
+        response, hedge = post_hedged(
+            structure_hedger,
+            "/chat/completions",
+            headers={
+                "Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}",
+                "Content-Type": "application/json",
+            },
+            json={
+                "model": MODEL,
                 "temperature": TEMPERATURE,
                 "messages": [
                     {"role": "system", "content": system_message},
@@ -277,33 +1686,96 @@ def build_structure_from_text(message_text: str) -> Dict[str, Any]:
                 "response_format": {"type": "json_schema", "json_schema": json_schema},
             },
         )
+        response.raise_for_status()
     except Exception as err:
         structure = {
             "ok": False,
             "error": type(err).__name__,
             "message": str(err),
+            "openai": openai_call_info(response, started, MODEL),
         }
-    else:
-        result = json.loads(
-            response.json()
-            .get("choices", [{}])[0]
-            .get("message", {})
-            .get("content", "null")
-        )
-        if result is None:
-            structure = {
-                "ok": False,
-                "error": None,
-                "response": response.json(),
-            }
-        else:
+        if isinstance(err, CircuitOpenError):
+            structure["deferred"] = True
+        return structure
+    openai = openai_call_info(response, started, MODEL)
+    if hedge is not None:
+        openai["hedge"] = hedge
+    result = json.loads(
+        response.json()
+        .get("choices", [{}])[0]
+        .get("message", {})
+        .get("content", "null")
+    )
+    if result is None:
+        return {
+            "ok": False,
+            "error": None,
+            "response": response.json(),
+            "openai": openai,
+        }
+    return {
+        "ok": True,
+        "result": result,
+        "openai": openai,
+    }
+
+
+def register_prompt() -> Optional[Dict[str, Any]]:
+    """Store the current prompt in the registry, once per container.
+
+    The definition is written with a conditional put under its content hash,
+    so concurrent or repeated registrations never overwrite each other.
+
+    Returns:
+        Reference to the registered prompt, or None if it could not be stored.
+    """
+    key = f"{PROMPT_REGISTRY_PREFIX}{PROMPT_HASH}.json"
+    if not _prompt_registered.is_set():
+        try:
+            write_s3_json(key, PROMPT_DEFINITION, IfNoneMatch="*")
+        except Exception as err:
+            if s3_error_code(err) not in PRECONDITION_FAILED_CODES:
+                logger.warning("Prompt registration failed for %s", key, exc_info=True)
+                return None
+        _prompt_registered.set()
+    return {"version": version, "hash": PROMPT_HASH, "key": key}
+
+
+def build_structure_from_text(message_text: str) -> Dict[str, Any]:
+    """Structure free text with ChatGPT, serving repeated texts from the cache.
+
+    Args:
+        message_text: Free-text content from the WhatsApp message.
+
+    Returns:
+        Structure payload enriched with metadata and ok/error state.
+    """
+    structure: Dict[str, Any]
+    if STRUCTURE_CACHE_ENABLED:
+        cache_key = structure_cache_key(message_text)
+        cached = lookup_structure_cache(cache_key)
+        if cached is not None:
+            result, tier = cached
             structure = {
                 "ok": True,
                 "result": result,
+                "cache": {"hit": True, "tier": tier, "key": cache_key},
             }
+        else:
+            structure = request_structure(message_text)
+            if structure["ok"]:
+                store_structure_cache(cache_key, structure["result"])
+            structure["cache"] = {"hit": False, "key": cache_key}
+    else:
+        structure = request_structure(message_text)
     structure["version"] = version
-    structure["system_message"] = system_message
-    structure["json_schema"] = json_schema
+    prompt = register_prompt()
+    if prompt is not None:
+        structure["prompt"] = prompt
+    else:
+        # Keep the record self-describing if the registry is unavailable
+        structure["system_message"] = system_message
+        structure["json_schema"] = json_schema
     return structure
 
 
@@ -317,16 +1789,488 @@ def persist_message_to_s3(
         output_filename: Name of the JSON file to write.
         message: Enriched message payload to persist.
     """
-    with tempfile.TemporaryDirectory() as td:
+    with stage_timer("s3_persist") as timer, tempfile.TemporaryDirectory() as td:
         full_filename = os.path.join(td, output_filename)
         with open(full_filename, "w") as output_file:
             json.dump(message, output_file)
+        timer.payload_bytes = os.path.getsize(full_filename)
         s3.upload_file(full_filename, S3_BUCKET, f"{s3_dir}/{output_filename}")
 
 
+def ledger_key(short_id: str) -> str:
+    """S3 key of the dedup ledger marker for a message."""
+    return f"{LEDGER_PREFIX}{short_id}.json"
+
+
+def claim_message(short_id: str, wamid: str) -> bool:
+    """Claim a message in the dedup ledger before doing any expensive work.
+
+    The marker is created with a conditional put, so only one invocation wins.
+    It expires when this invocation does (see `set_invocation_deadline`), since
+    every claim is completed or released before the handler returns. A marker
+    left `in_progress` past its `expires_at` is taken over, guarded by its ETag;
+    markers without one expire `LEDGER_LEASE_SECONDS` after `claimed_at`.
+
+    Args:
+        short_id: Stable short id of the message.
+        wamid: Original WhatsApp message id, recorded in the marker.
+
+    Returns:
+        True if this invocation should process the message.
+    """
+    key = ledger_key(short_id)
+    now = time.time()
+    marker = {
+        "wamid": wamid,
+        "status": "in_progress",
+        "claimed_at": now,
+        "expires_at": (
+            _invocation_expires_at
+            if _invocation_expires_at is not None
+            else now + LEDGER_LEASE_SECONDS
+        ),
+    }
+    try:
+        write_s3_json(key, marker, IfNoneMatch="*")
+        return True
+    except Exception as err:
+        if s3_error_code(err) not in PRECONDITION_FAILED_CODES:
+            raise
+
+    try:
+        obj = s3.get_object(Bucket=S3_BUCKET, Key=key)
+    except Exception as err:
+        if s3_error_code(err) in ("NoSuchKey", "404"):
+            # Released between our put and this read; let the redelivery retry it
+            return False
+        raise
+    existing = json.loads(obj["Body"].read().decode("utf-8"))
+    if existing.get("status") == "done":
+        return False
+    expires_at = existing.get(
+        "expires_at", existing.get("claimed_at", 0) + LEDGER_LEASE_SECONDS
+    )
+    if time.time() < expires_at:
+        return False
+
+    try:
+        write_s3_json(key, marker, IfMatch=obj["ETag"])
+        return True
+    except Exception as err:
+        if s3_error_code(err) not in PRECONDITION_FAILED_CODES:
+            raise
+        return False
+
+
+def complete_message(short_id: str, wamid: str, output_key: str) -> None:
+    """Mark a message as done in the dedup ledger.
+
+    Args:
+        short_id: Stable short id of the message.
+        wamid: Original WhatsApp message id.
+        output_key: S3 key of the persisted record.
+    """
+    write_s3_json(
+        ledger_key(short_id),
+        {
+            "wamid": wamid,
+            "status": "done",
+            "completed_at": time.time(),
+            "output_key": output_key,
+        },
+    )
+
+
+def release_message(short_id: str) -> None:
+    """Drop a claim after a failure so a redelivery can process the message."""
+    try:
+        s3.delete_object(Bucket=S3_BUCKET, Key=ledger_key(short_id))
+    except Exception:
+        logger.warning("Could not release ledger claim %s", short_id, exc_info=True)
+
+
+def structure_message_text(message: Dict[str, Any], message_text: str) -> None:
+    """Triage a message's text and structure it unless it is not a report.
+
+    Sets `message["triage"]` (when triage is enabled) and
+    `message["structure"]`, which stays None for skipped messages.
+
+    Args:
+        message: WhatsApp message payload to update in place.
+        message_text: Text body or transcription of the message.
+    """
+    with stage_timer("gpt") as timer:
+        timer.payload_bytes = len(message_text.encode("utf-8"))
+        if TRIAGE_ENABLED:
+            message["triage"] = triage.classify(message_text)
+            if message["triage"]["decision"] == triage.NOT_REPORT:
+                message["structure"] = None
+                timer.outcome = "skipped"
+                return
+        message["structure"] = build_structure_from_text(message_text)
+        timer.outcome = payload_outcome(message["structure"])
+
+
+def first_enrichment_stage(message: Dict[str, Any]) -> Optional[str]:
+    """Enrichment stage a new message starts at, or None if it has no text."""
+    if message.get("type") == "audio":
+        return "transcribe"
+    if message.get("type") == "text" and message.get("text", {}).get("body"):
+        return "structure"
+    return None
+
+
+ENRICHMENT_STAGES = ("transcribe", "structure")
+
+
+def stage_queue_url(stage: str) -> str:
+    """URL of the work queue for an enrichment stage; empty if it runs inline."""
+    return {"transcribe": TRANSCRIBE_QUEUE_URL, "structure": STRUCTURE_QUEUE_URL}[stage]
+
+
+def save_message(message: Dict[str, Any], key: str) -> None:
+    """Persist a message record under its full S3 key."""
+    s3_dir, _, output_filename = key.rpartition("/")
+    persist_message_to_s3(s3_dir, output_filename, message)
+
+
+def deferred_stages(message: Dict[str, Any]) -> List[str]:
+    """Enrichment payloads of a message that failed fast on the open breaker."""
+    return [
+        stage
+        for stage in ("transcription", "structure")
+        if (message.get(stage) or {}).get("deferred")
+    ]
+
+
+def deferral_key(message: Dict[str, Any]) -> str:
+    """S3 key of the marker listing a deferred message or aggregate."""
+    short_id = normalize_wamid(message.get("id") or message.get("window_id", ""))
+    return f"{DEFERRED_PREFIX}{short_id}.json"
+
+
+def defer_message(message: Dict[str, Any], key: str, stages: List[str]) -> None:
+    """Mark a message as deferred and spill a marker pointing at its record.
+
+    The marker is best effort: a full reprocessing scan still finds the
+    record through its failed payloads.
+    """
+    message["deferred"] = {"stages": stages, "deferred_at": time.time()}
+    try:
+        write_s3_json(deferral_key(message), {"key": key, **message["deferred"]})
+    except Exception:
+        logger.warning("Could not write the deferral marker of %s", key, exc_info=True)
+
+
+def release_deferral(message: Dict[str, Any]) -> None:
+    """Delete a message's deferral marker, once it has been enriched."""
+    try:
+        s3.delete_object(Bucket=S3_BUCKET, Key=deferral_key(message))
+    except Exception:
+        logger.warning("Could not delete %s", deferral_key(message), exc_info=True)
+
+
+def advance_enrichment(
+    message: Dict[str, Any], key: str, stage: Optional[str], orig_phone_id: str
+) -> None:
+    """Run the next enrichment stage of a message, queue it, or finish.
+
+    A stage whose queue is configured is not run here: the message is persisted
+    as `enrichment: {"status": "queued"}` and a job naming the stage is sent to
+    the queue. Without a next stage, the message is persisted as it is, and
+    marked deferred if OpenAI calls failed fast on the open circuit breaker.
+
+    Args:
+        message: WhatsApp message payload, enriched so far.
+        key: S3 key of the message record.
+        stage: Next stage ("transcribe" or "structure"), or None if done.
+        orig_phone_id: Phone id used to fetch media.
+    """
+    if stage is None:
+        if "enrichment" in message:
+            message["enrichment"] = {"status": "done", "completed_at": time.time()}
+        stages = deferred_stages(message)
+        if stages:
+            defer_message(message, key, stages)
+        save_message(message, key)
+        return
+
+    queue_url = stage_queue_url(stage)
+    if not queue_url:
+        run_enrichment_stage(message, key, stage, orig_phone_id)
+        return
+
+    message["enrichment"] = {
+        "status": "queued",
+        "stage": stage,
+        "queued_at": time.time(),
+    }
+    save_message(message, key)
+    job = {"stage": stage, "key": key, "orig_phone_id": orig_phone_id}
+    with stage_timer("enqueue", QueueStage=stage):
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(job))
+
+
+def run_enrichment_stage(
+    message: Dict[str, Any], key: str, stage: str, orig_phone_id: str
+) -> None:
+    """Run one enrichment stage on a message, then advance to the next.
+
+    "transcribe" attaches the audio transcription; "structure" triages and
+    structures the text, or, with coalescing enabled, marks the message as a
+    pending fragment of its sender's window, which is structured when it
+    closes.
+
+    Args:
+        message: WhatsApp message payload to update in place.
+        key: S3 key of the message record.
+        stage: Stage to run.
+        orig_phone_id: Phone id used to fetch media.
+    """
+    if stage == "transcribe":
+        message_text = handle_audio_message(
+            message, orig_phone_id, key.rpartition("/")[0]
+        )
+        next_stage = "structure" if message_text is not None else None
+        advance_enrichment(message, key, next_stage, orig_phone_id)
+        return
+
+    if message.get("type") == "text":
+        message_text = message.get("text", {}).get("body")
+    else:
+        message_text = (message.get("transcription") or {}).get("text")
+    if message_text is None:
+        # Nothing to structure, e.g. an audio note whose transcription failed
+        message["structure"] = None
+        advance_enrichment(message, key, None, orig_phone_id)
+        return
+
+    sender = message.get("from")
+    if COALESCE_WINDOW_SECONDS <= 0 or not sender:
+        structure_message_text(message, message_text)
+        advance_enrichment(message, key, None, orig_phone_id)
+        return
+
+    message["coalesce"] = {"status": "pending"}
+    advance_enrichment(message, key, None, orig_phone_id)
+    add_fragment(
+        sender,
+        {
+            "id": normalize_wamid(message.get("id", "")),
+            "key": key,
+            "timestamp": parse_timestamp(message),
+            "text": message_text,
+        },
+    )
+
+
+def coalesce_state_key(sender: str) -> str:
+    """S3 key of a sender's coalescing state."""
+    return f"{COALESCE_PREFIX}windows/{sender}.json"
+
+
+def coalesce_aggregate_key(window_id: str) -> str:
+    """S3 key of the combined record of a closed window."""
+    return f"{COALESCE_PREFIX}aggregates/{window_id}.json"
+
+
+def read_coalesce_state(sender: str) -> Tuple[Dict[str, Any], Optional[str]]:
+    """Read a sender's coalescing state and its ETag (None if there is none yet).
+
+    The state holds the open `window` (or None) and the closed windows still
+    `flushing`, each with its fragments: message id, record key, timestamp and
+    text.
+    """
+    try:
+        obj = s3.get_object(Bucket=S3_BUCKET, Key=coalesce_state_key(sender))
+    except Exception as err:
+        if s3_error_code(err) in ("NoSuchKey", "404"):
+            return {"sender": sender, "window": None, "flushing": []}, None
+        raise
+    return json.loads(obj["Body"].read().decode("utf-8")), obj["ETag"]
+
+
+def write_coalesce_state(
+    sender: str, state: Dict[str, Any], etag: Optional[str]
+) -> bool:
+    """Replace a sender's state if nobody changed it since it was read.
+
+    Returns:
+        False if another invocation won the race; re-read and try again.
+    """
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        write_s3_json(coalesce_state_key(sender), state, **condition)
+        return True
+    except Exception as err:
+        if s3_error_code(err) not in PRECONDITION_FAILED_CODES:
+            raise
+        return False
+
+
+def window_expired(window: Dict[str, Any], now: float) -> bool:
+    return (
+        now - window["last_at"] >= COALESCE_WINDOW_SECONDS
+        or now - window["opened_at"] >= COALESCE_MAX_SECONDS
+    )
+
+
+def close_window(state: Dict[str, Any], now: float) -> Dict[str, Any]:
+    """Move the open window of a state to its flushing list."""
+    window = state["window"]
+    state["window"] = None
+    state["flushing"].append({"window": window, "started_at": now})
+    return window
+
+
+def add_fragment(sender: str, fragment: Dict[str, Any]) -> str:
+    """Add a message to its sender's open window, opening one if needed.
+
+    An expired window is closed and flushed first, in this invocation; if
+    that flush fails, `sweep_coalesce_windows` redoes it after its lease.
+
+    Args:
+        sender: Sender phone number.
+        fragment: Message `id`, record `key`, `timestamp` and `text`.
+
+    Returns:
+        Id of the window the fragment joined.
+
+    Raises:
+        RuntimeError: If the state kept changing under us.
+    """
+    for _ in range(COALESCE_STATE_ATTEMPTS):
+        state, etag = read_coalesce_state(sender)
+        now = time.time()
+        expired = None
+        if state["window"] is not None and window_expired(state["window"], now):
+            expired = close_window(state, now)
+        if state["window"] is None:
+            state["window"] = {
+                "window_id": f"{sender}-{int(now * 1000)}",
+                "opened_at": now,
+                "last_at": now,
+                "fragments": [],
+            }
+        window = state["window"]
+        if all(known["id"] != fragment["id"] for known in window["fragments"]):
+            window["fragments"].append(fragment)
+        window["last_at"] = now
+        if write_coalesce_state(sender, state, etag):
+            if expired is not None:
+                try:
+                    flush_window(sender, expired)
+                except Exception:
+                    # The fragment is safely in its window; the sweep retries
+                    logger.exception("Flushing window %s failed", expired["window_id"])
+            return window["window_id"]
+    raise RuntimeError(f"Could not update the coalescing window of {sender}")
+
+
+def flush_window(sender: str, window: Dict[str, Any]) -> None:
+    """Structure a closed window's combined text and link it from each fragment.
+
+    Safe to repeat: the aggregate key and the links only depend on the window.
+    An aggregate whose structuring failed fast on the open circuit breaker is
+    marked deferred like a message; `reprocess.py` also retries failed and
+    outdated aggregates.
+
+    Args:
+        sender: Sender phone number.
+        window: Closed window, as stored in the sender's state.
+    """
+    fragments = sorted(window["fragments"], key=lambda item: item["timestamp"])
+    text = "\n".join(fragment["text"] for fragment in fragments)
+    aggregate_key = coalesce_aggregate_key(window["window_id"])
+    aggregate: Dict[str, Any] = {
+        "window_id": window["window_id"],
+        "from": sender,
+        "opened_at": window["opened_at"],
+        "closed_at": time.time(),
+        "fragments": [fragment["key"] for fragment in fragments],
+        "text": text,
+    }
+    structure_message_text(aggregate, text)
+    stages = deferred_stages(aggregate)
+    if stages:
+        defer_message(aggregate, aggregate_key, stages)
+    write_s3_json(aggregate_key, aggregate)
+
+    for position, fragment in enumerate(fragments):
+        record = read_s3_json(fragment["key"])
+        if record is None:
+            logger.warning("Coalesced fragment %s is missing", fragment["key"])
+            continue
+        record["coalesce"] = {
+            "status": "done",
+            "window_id": window["window_id"],
+            "aggregate": aggregate_key,
+            "position": position,
+            "fragments": len(fragments),
+        }
+        write_s3_json(fragment["key"], record)
+
+    for _ in range(COALESCE_STATE_ATTEMPTS):
+        state, etag = read_coalesce_state(sender)
+        remaining = [
+            entry
+            for entry in state["flushing"]
+            if entry["window"]["window_id"] != window["window_id"]
+        ]
+        if etag is None or len(remaining) == len(state["flushing"]):
+            return
+        state["flushing"] = remaining
+        if write_coalesce_state(sender, state, etag):
+            return
+    logger.warning("Could not mark window %s as flushed", window["window_id"])
+
+
+def sweep_coalesce_windows() -> Dict[str, int]:
+    """Close expired windows and redo abandoned flushes, for every sender.
+
+    Meant for a scheduled invocation, so that the last window of a sender who
+    goes quiet does not wait for their next message.
+
+    Returns:
+        Number of sender states seen and of windows flushed.
+    """
+    prefix = f"{COALESCE_PREFIX}windows/"
+    stats = {"senders": 0, "flushed": 0}
+    for page in s3.get_paginator("list_objects_v2").paginate(
+        Bucket=S3_BUCKET, Prefix=prefix
+    ):
+        for content in page.get("Contents", []):
+            sender = content["Key"][len(prefix) : -len(".json")]
+            stats["senders"] += 1
+            for _ in range(COALESCE_STATE_ATTEMPTS):
+                state, etag = read_coalesce_state(sender)
+                now = time.time()
+                due = [
+                    entry
+                    for entry in state["flushing"]
+                    if now - entry["started_at"] >= COALESCE_FLUSH_LEASE_SECONDS
+                ]
+                for entry in due:
+                    entry["started_at"] = now
+                windows = [entry["window"] for entry in due]
+                if state["window"] is not None and window_expired(state["window"], now):
+                    windows.append(close_window(state, now))
+                if not windows:
+                    break
+                if write_coalesce_state(sender, state, etag):
+                    for window in windows:
+                        flush_window(sender, window)
+                    stats["flushed"] += len(windows)
+                    break
+    return stats
+
+
 def process_message(message: Dict[str, Any], orig_phone_id: str) -> None:
     """Process a single WhatsApp message, enrich it, and persist it.
 
+    Messages already claimed in the dedup ledger are skipped. Stages with a
+    work queue are left to its consumers (see `advance_enrichment`).
+
     Args:
         message: WhatsApp message payload to process.
         orig_phone_id: Phone id used to fetch media and process message.
@@ -341,28 +2285,39 @@ def process_message(message: Dict[str, Any], orig_phone_id: str) -> None:
 
     s3_dir, output_filename = build_output_paths(timestamp, sender, short_id)
 
-    message_text = None
-    if message.get("type") == "text":
-        message_text = message.get("text", {}).get("body")
-    elif message.get("type") == "audio":
-        message_text = handle_audio_message(message, orig_phone_id, s3_dir)
+    with stage_timer(
+        "message", MessageType=message.get("type"), MessageId=short_id
+    ) as timer:
+        if DEDUP_ENABLED and not claim_message(short_id, wamid):
+            logger.info("Skipping duplicate delivery of message %s", wamid)
+            timer.outcome = "skipped"
+            return
 
-    structure = (
-        build_structure_from_text(message_text) if message_text is not None else None
-    )
-    message["structure"] = structure
-    persist_message_to_s3(s3_dir, output_filename, message)
+        try:
+            message["structure"] = None
+            advance_enrichment(
+                message,
+                f"{s3_dir}/{output_filename}",
+                first_enrichment_stage(message),
+                orig_phone_id,
+            )
+        except BaseException:
+            if DEDUP_ENABLED:
+                release_message(short_id)
+            raise
 
+        if DEDUP_ENABLED:
+            complete_message(short_id, wamid, f"{s3_dir}/{output_filename}")
 
-def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, int]:
-    """AWS Lambda entrypoint.
+
+def iter_messages(event: Dict[str, Any]) -> Iterator[Tuple[Dict[str, Any], str]]:
+    """Walk SNS records and webhook changes, yielding every WhatsApp message.
 
     Args:
         event: Lambda event containing SNS records.
-        context: Lambda context (unused).
 
-    Returns:
-        HTTP-style status code dict to signal success.
+    Yields:
+        Tuples of the WhatsApp message payload and its origination phone id.
     """
     for record in event.get("Records", []):
         whatsapp_message, payload = parse_sns_record(record)
@@ -372,6 +2327,172 @@ def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, int]:
             value = change.get("value", {})
 
             for message in value.get("messages", []):
-                process_message(message, orig_phone_id)
+                yield message, orig_phone_id
+
+
+def process_messages(
+    messages: Iterable[Tuple[Dict[str, Any], str]], max_in_flight: int
+) -> None:
+    """Process messages serially, or concurrently on a bounded worker pool.
+
+    In the concurrent mode every message is attempted even if another one
+    fails. Failures are logged as they are collected and the first one, in
+    arrival order, is re-raised once the batch has drained, so the invocation
+    still reports failure exactly like the serial path does.
+
+    Args:
+        messages: Message payloads paired with their origination phone id.
+        max_in_flight: Maximum number of messages processed at the same time.
+    """
+    if max_in_flight <= 1:
+        for message, orig_phone_id in messages:
+            process_message(message, orig_phone_id)
+        return
+
+    futures: List[Tuple[Dict[str, Any], Future]] = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for message, orig_phone_id in messages:
+            futures.append(
+                (message, executor.submit(process_message, message, orig_phone_id))
+            )
+
+    first_error: Optional[BaseException] = None
+    for message, future in futures:
+        error = future.exception()
+        if error is None:
+            continue
+        logger.error(
+            "Failed to process message %s",
+            message.get("id"),
+            exc_info=(type(error), error, error.__traceback__),
+        )
+        if first_error is None:
+            first_error = error
+    if first_error is not None:
+        raise first_error
+
+
+def run_enrichment_job(job: Dict[str, Any]) -> None:
+    """Run a queued enrichment stage on the stored message record.
+
+    A job whose record is done, or queued for an earlier stage, is a
+    redelivery and is dropped. A record queued for a later stage means an
+    earlier attempt ran this job's stage but failed to queue the next one, so
+    that is queued again.
+
+    Args:
+        job: Job body: the `stage`, the record `key` and the `orig_phone_id`.
+    """
+    key = job["key"]
+    with stage_timer("job", QueueStage=job["stage"], MessageKey=key) as timer:
+        record = read_s3_json(key)
+        enrichment = (record or {}).get("enrichment") or {}
+        pending = ENRICHMENT_STAGES[ENRICHMENT_STAGES.index(job["stage"]) :]
+        if (
+            record is None
+            or enrichment.get("status") != "queued"
+            or enrichment.get("stage") not in pending
+        ):
+            logger.info("Skipping stale %s job for %s", job["stage"], key)
+            timer.outcome = "skipped"
+            return
+        if enrichment["stage"] != job["stage"]:
+            advance_enrichment(record, key, enrichment["stage"], job["orig_phone_id"])
+            return
+        run_enrichment_stage(record, key, job["stage"], job["orig_phone_id"])
+
+
+def process_enrichment_jobs(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Run the jobs of a queue-triggered invocation on a bounded worker pool.
+
+    Args:
+        event: SQS event whose record bodies are enrichment jobs.
+
+    Returns:
+        SQS partial batch response listing the failed jobs, which the queue
+        delivers again (the event source mapping needs
+        ReportBatchItemFailures).
+    """
+    records = event.get("Records", [])
+    futures: List[Tuple[Dict[str, Any], Future]] = []
+    with ThreadPoolExecutor(max_workers=max(MAX_IN_FLIGHT_MESSAGES, 1)) as executor:
+        for record in records:
+            # Parsed in the worker, so a malformed body fails only its own item
+            futures.append(
+                (
+                    record,
+                    executor.submit(
+                        lambda body: run_enrichment_job(json.loads(body)),
+                        record["body"],
+                    ),
+                )
+            )
+
+    failures = []
+    for record, future in futures:
+        error = future.exception()
+        if error is None:
+            continue
+        logger.error(
+            "Enrichment job %s failed",
+            record.get("messageId"),
+            exc_info=(type(error), error, error.__traceback__),
+        )
+        failures.append({"itemIdentifier": record.get("messageId")})
+    return {"batchItemFailures": failures}
+
+
+def init_report() -> Dict[str, Any]:
+    """Time spent initializing this module and each lazily imported module.
+
+    Returns:
+        Milliseconds for the module body (after its standard library imports)
+        and for every module loaded through `lazy_import` so far.
+    """
+    return {
+        "module_init_ms": round(MODULE_INIT_MS, 1),
+        "lazy_imports_ms": {
+            name: round(elapsed, 1) for name, elapsed in IMPORT_TIMINGS.items()
+        },
+    }
+
+
+_cold_start = True
+
+
+def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """AWS Lambda entrypoint.
+
+    Args:
+        event: Lambda event containing SNS records, SQS records carrying
+            enrichment jobs, or a scheduled `{"coalesce_sweep": true}` event
+            that closes idle coalescing windows.
+        context: Lambda context, used to budget OpenAI retries.
+
+    Returns:
+        HTTP-style status code dict to signal success, or the partial batch
+        response for SQS events.
+    """
+    set_invocation_deadline(context)
+    if event.get("coalesce_sweep"):
+        logger.info("Coalescing sweep: %s", json.dumps(sweep_coalesce_windows()))
+        return {"statusCode": 200}
+    if any(
+        record.get("eventSource") == "aws:sqs" for record in event.get("Records", [])
+    ):
+        response = process_enrichment_jobs(event)
+    else:
+        process_messages(iter_messages(event), MAX_IN_FLIGHT_MESSAGES)
+        response = {"statusCode": 200}
+    logger.info("OpenAI connection stats: %s", json.dumps(openai_connection_stats()))
+    if STRUCTURE_HEDGE_PERCENTILE > 0:
+        logger.info("Hedging stats: %s", json.dumps(structure_hedger.stats()))
+    global _cold_start
+    if _cold_start:
+        # After the first invocation, so the lazy imports it triggered are included
+        _cold_start = False
+        logger.info("Init report: %s", json.dumps(init_report()))
+    return response
+
 
-    return {"statusCode": 200}
+MODULE_INIT_MS = (time.perf_counter() - _MODULE_STARTED) * 1000
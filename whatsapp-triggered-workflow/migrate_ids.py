@@ -0,0 +1,104 @@
+"""Move records written with process-randomized ids to their deterministic keys.
+
+Records persisted before `normalize_wamid` switched to a stable digest carry a
+short id derived from Python's `hash()`, so the same wamid may have been
+written under several keys. This helper recomputes the id from each record's
+`id` field, copies the record to its deterministic key (keeping whichever copy
+got there first), deletes the old key and backfills the dedup ledger so future
+redeliveries are skipped.
+
+It needs s3:ListBucket, s3:GetObject, s3:PutObject and s3:DeleteObject on the
+whole bucket, so run it with operator credentials rather than the Lambda role.
+
+Usage:
+    python migrate_ids.py [--prefix 2025-10-] [--apply]
+"""
+
+import argparse
+import json
+from typing import Any, Dict, Optional
+
+import lambda_function as ingestion  # type: ignore[import-not-found]
+
+
+def migrated_key(key: str, record: Dict[str, Any]) -> Optional[str]:
+    """Return the deterministic key for a record, or None if it cannot be derived.
+
+    Only the trailing short id of the filename changes; the date directory and
+    sender/time part are kept as written, so the result does not depend on the
+    local timezone of whoever runs the migration.
+
+    Args:
+        key: Current S3 key of the record.
+        record: Persisted WhatsApp message.
+
+    Returns:
+        The key the record would be written to today.
+    """
+    wamid = record.get("id")
+    if not wamid or not key.endswith(".json") or "-" not in key:
+        return None
+    head, _ = key[: -len(".json")].rsplit("-", 1)
+    return f"{head}-{ingestion.normalize_wamid(wamid)}.json"
+
+
+def migrate(prefix: str = "", apply: bool = False) -> Dict[str, int]:
+    """Rewrite legacy record keys under a prefix.
+
+    Args:
+        prefix: Only keys starting with this prefix are considered.
+        apply: Without it, only report what would change.
+
+    Returns:
+        Counters for unchanged, moved, duplicate and skipped records.
+    """
+    s3 = ingestion.s3
+    bucket = ingestion.S3_BUCKET
+    stats = {"unchanged": 0, "moved": 0, "duplicates": 0, "skipped": 0}
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for content in page.get("Contents", []):
+            key = content["Key"]
+            if not key.endswith(".json") or key.startswith("_"):
+                continue
+            record = ingestion.read_s3_json(key)
+            new_key = migrated_key(key, record or {})
+            if record is None or new_key is None:
+                stats["skipped"] += 1
+                continue
+            if new_key == key:
+                stats["unchanged"] += 1
+                continue
+
+            duplicate = False
+            if apply:
+                try:
+                    ingestion.write_s3_json(new_key, record, IfNoneMatch="*")
+                except Exception as err:
+                    if (
+                        ingestion.s3_error_code(err)
+                        not in ingestion.PRECONDITION_FAILED_CODES
+                    ):
+                        raise
+                    duplicate = True
+                ingestion.complete_message(
+                    ingestion.normalize_wamid(record["id"]), record["id"], new_key
+                )
+                s3.delete_object(Bucket=bucket, Key=key)
+            stats["duplicates" if duplicate else "moved"] += 1
+            print(f"{key} -> {new_key}{' (duplicate)' if duplicate else ''}")
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--prefix", default="", help="only migrate keys under it")
+    parser.add_argument(
+        "--apply", action="store_true", help="perform the moves (default: dry run)"
+    )
+    args = parser.parse_args()
+    print(json.dumps(migrate(args.prefix, args.apply)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""Read and split Ogg/Opus streams at page boundaries without decoding audio.
+
+WhatsApp voice notes are single-stream Ogg files carrying Opus. Each split
+segment repeats the stream's header pages (OpusHead and OpusTags), carries a
+run of whole audio pages, and gets renumbered page sequence numbers, granule
+positions rebased to start at zero, an end-of-stream flag on its last page
+and fresh CRCs, so it is a valid Ogg/Opus file on its own. See RFC 3533 (Ogg)
+and RFC 7845 (Opus in Ogg).
+"""
+
+import io
+import struct
+import zlib
+from typing import IO, Callable, Iterator, List, NamedTuple, Optional
+
+CAPTURE_PATTERN = b"OggS"
+HEADER = struct.Struct("<4sBBqIIIB")  # up to and including the segment count
+OPUS_SAMPLE_RATE = 48000  # Opus granule positions always count 48 kHz samples
+NO_GRANULE = -1  # granule of pages on which no packet ends
+
+FLAG_CONTINUED = 0x01
+FLAG_EOS = 0x04
+
+
+# Bit-reversal of every byte value, to run Ogg's CRC through zlib (see ogg_crc)
+_REVERSED_BITS = bytes(int(f"{value:08b}"[::-1], 2) for value in range(256))
+
+
+def ogg_crc(data: bytes) -> int:
+    """Ogg's CRC-32: polynomial 0x04C11DB7, no reflection, zero init and xor.
+
+    zlib implements the reflected form of the same polynomial, so the input
+    bytes and the result are bit-reversed around it instead of running a
+    byte-at-a-time Python loop over the whole file.
+    """
+    reflected = ~zlib.crc32(data.translate(_REVERSED_BITS), 0xFFFFFFFF) & 0xFFFFFFFF
+    return int(f"{reflected:032b}"[::-1], 2)
+
+
+class OggPage(NamedTuple):
+    """One Ogg page; `lacing` is its segment table."""
+
+    header_type: int
+    granule: int
+    serial: int
+    sequence: int
+    lacing: bytes
+    body: bytes
+
+    @property
+    def continued(self) -> bool:
+        """Whether the page starts in the middle of a packet."""
+        return bool(self.header_type & FLAG_CONTINUED)
+
+    @property
+    def size(self) -> int:
+        return HEADER.size + len(self.lacing) + len(self.body)
+
+    def to_bytes(self) -> bytes:
+        header = HEADER.pack(
+            CAPTURE_PATTERN,
+            0,
+            self.header_type,
+            self.granule,
+            self.serial,
+            self.sequence,
+            0,
+            len(self.lacing),
+        )
+        page = header + self.lacing + self.body
+        crc = ogg_crc(page)
+        return page[:22] + struct.pack("<I", crc) + page[26:]
+
+
+def read_page(data: bytes, offset: int) -> Optional[OggPage]:
+    """Parse the page starting at `offset`, or return None if there is none."""
+    if data[offset : offset + 4] != CAPTURE_PATTERN:
+        return None
+    if offset + HEADER.size > len(data):
+        return None
+    _, _, header_type, granule, serial, sequence, _, count = HEADER.unpack_from(
+        data, offset
+    )
+    lacing_start = offset + HEADER.size
+    lacing = data[lacing_start : lacing_start + count]
+    body_start = lacing_start + count
+    body = data[body_start : body_start + sum(lacing)]
+    if len(lacing) != count or len(body) != sum(lacing):
+        return None
+    return OggPage(header_type, granule, serial, sequence, lacing, body)
+
+
+def iter_pages(fileobj: IO[bytes]) -> Iterator[OggPage]:
+    """Parse an Ogg stream page by page from a file object.
+
+    Only the page being read is held in memory.
+
+    Args:
+        fileobj: Binary file positioned at the first page.
+
+    Raises:
+        ValueError: If the data is not a well-formed Ogg stream.
+    """
+    offset = 0
+    while True:
+        header = fileobj.read(HEADER.size)
+        if not header:
+            return
+        if len(header) < HEADER.size or not header.startswith(CAPTURE_PATTERN):
+            raise ValueError(f"no valid Ogg page at offset {offset}")
+        _, _, header_type, granule, serial, sequence, _, count = HEADER.unpack(header)
+        lacing = fileobj.read(count)
+        body = fileobj.read(sum(lacing))
+        if len(lacing) != count or len(body) != sum(lacing):
+            raise ValueError(f"truncated Ogg page at offset {offset}")
+        page = OggPage(header_type, granule, serial, sequence, lacing, body)
+        offset += page.size
+        yield page
+
+
+def pre_skip(first_page: OggPage) -> int:
+    """Samples the decoder drops at the start, read from the OpusHead packet.
+
+    Raises:
+        ValueError: If the stream is not Opus.
+    """
+    if not first_page.body.startswith(b"OpusHead"):
+        raise ValueError("not an Ogg/Opus stream")
+    return struct.unpack_from("<H", first_page.body, 10)[0]
+
+
+def duration_seconds(fileobj: IO[bytes], tail_bytes: int = 65536) -> float:
+    """Read an Ogg/Opus stream's duration from its first and last pages only.
+
+    Args:
+        fileobj: Seekable binary file positioned anywhere; it is rewound.
+        tail_bytes: How much of the end of the file to search for the last page.
+
+    Returns:
+        Duration in seconds.
+
+    Raises:
+        ValueError: If the stream is not Ogg/Opus or has no final granule.
+    """
+    fileobj.seek(0)
+    head = fileobj.read(65536)
+    first = read_page(head, 0)
+    if first is None:
+        raise ValueError("not an Ogg stream")
+    skip = pre_skip(first)
+
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(max(size - tail_bytes, 0))
+    tail = fileobj.read()
+    fileobj.seek(0)
+
+    offset = tail.rfind(CAPTURE_PATTERN)
+    while offset >= 0:
+        page = read_page(tail, offset)
+        if page is not None and page.granule != NO_GRANULE:
+            return max(page.granule - skip, 0) / OPUS_SAMPLE_RATE
+        offset = tail.rfind(CAPTURE_PATTERN, 0, offset)
+    raise ValueError("no granule position found near the end of the stream")
+
+
+def read_header_pages(pages: Iterator[OggPage]) -> List[OggPage]:
+    """Take the leading pages holding the OpusHead and OpusTags packets.
+
+    Raises:
+        ValueError: If the stream is not Ogg/Opus or ends inside its headers.
+    """
+    first = next(pages, None)
+    if first is None:
+        raise ValueError("empty Ogg stream")
+    pre_skip(first)
+    headers = [first]
+    # OpusTags starts on the second page and may span several; audio starts
+    # on the page after the one where it ends
+    for page in pages:
+        headers.append(page)
+        if page.lacing and page.lacing[-1] < 255:
+            return headers
+    raise ValueError("Ogg/Opus stream ends inside its header packets")
+
+
+def split_opus(
+    fileobj: IO[bytes],
+    max_seconds: float,
+    max_bytes: int,
+    new_segment: Callable[[], IO[bytes]] = io.BytesIO,
+) -> Iterator[IO[bytes]]:
+    """Split an Ogg/Opus stream into standalone segments at page boundaries.
+
+    A segment is closed once it holds at least `max_seconds` of audio, or before
+    it would exceed `max_bytes`, but only in front of a page that starts a new
+    packet. Pages are read from `fileobj` one at a time and segments are
+    yielded as they are completed, so memory use does not grow with the length
+    of the stream.
+
+    Args:
+        fileobj: Binary file positioned at the start of the stream; it must
+            not be moved until the generator is exhausted.
+        max_seconds: Target duration of each segment.
+        max_bytes: Upper bound on the size of each segment.
+        new_segment: Opens the writable, seekable file a segment is written to.
+
+    Yields:
+        Segment files in playback order, rewound, which the caller closes; a
+        single one if no split was needed.
+
+    Raises:
+        ValueError: If the data is not a well-formed Ogg/Opus stream.
+    """
+    pages = iter_pages(fileobj)
+    headers = read_header_pages(pages)
+    header_size = sum(page.size for page in headers)
+
+    def open_segment() -> IO[bytes]:
+        segment = new_segment()
+        for sequence, page in enumerate(headers):
+            segment.write(page._replace(sequence=sequence).to_bytes())
+        return segment
+
+    def write(segment: IO[bytes], page: OggPage, last: bool) -> None:
+        header_type = page.header_type | (FLAG_EOS if last else 0)
+        segment.write(page._replace(header_type=header_type).to_bytes())
+
+    segment = open_segment()
+    try:
+        pending: Optional[OggPage] = None  # last page, written once the next is seen
+        sequence = len(headers)
+        group_start = 0  # granule at the end of the previous segment
+        group_end = 0
+        group_size = header_size
+        for page in pages:
+            full = (group_end - group_start) >= max_seconds * OPUS_SAMPLE_RATE or (
+                group_size + page.size > max_bytes
+            )
+            if pending is not None and full and not page.continued:
+                write(segment, pending, last=True)
+                pending = None
+                segment.seek(0)
+                done, segment = segment, open_segment()
+                yield done
+                sequence = len(headers)
+                group_start = group_end
+                group_size = header_size
+            if pending is not None:
+                write(segment, pending, last=False)
+            granule = page.granule
+            if granule != NO_GRANULE:
+                group_end = granule
+                granule -= group_start
+            pending = page._replace(granule=granule, sequence=sequence)
+            sequence += 1
+            group_size += page.size
+        if pending is not None:
+            write(segment, pending, last=True)
+    except BaseException:
+        segment.close()
+        raise
+    segment.seek(0)
+    yield segment
@@ -0,0 +1,309 @@
+"""Resumable bulk job that re-enriches stored messages.
+
+Records are picked up when their transcription or structure failed, or when the
+structure was built with an older prompt `version` than the ingestion module's.
+Records the triage rules marked as not a report are skipped unless
+`triage.RULES_VERSION` has changed since, and coalesced fragments are never
+structured on their own: their window's aggregate, under `_coalesce/aggregates/`,
+holds the structure and is re-structured from its combined text instead.
+Records still queued for an enrichment stage are left to the queue consumers.
+
+With `deferred`, only the records listed under `_deferred/` (those whose
+OpenAI calls failed fast while the circuit breaker was open) are visited,
+instead of scanning the bucket; markers are deleted as their records are
+brought up to date.
+They are re-run through the ingestion Lambda's own enrichment functions with
+bounded parallelism and a shared rate limit, and written back in place.
+
+Progress is checkpointed under `_jobs/reprocess/<job_id>.json` after every
+page of keys, so a job can be continued across many Lambda invocations (the
+handler returns `done: False` when it runs out of time; invoke it again with
+the same `job_id`) or run to completion locally:
+
+    python reprocess.py --job-id version-2 --prefix 2025- --workers 4 --rate 2
+    python reprocess.py --job-id outage-2025-10-09 --deferred
+"""
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import lambda_function as ingestion  # type: ignore[import-not-found]
+
+JOB_PREFIX = "_jobs/reprocess/"
+PAGE_SIZE = 50  # keys per checkpoint
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 2.0  # records started per second, across all workers
+STOP_MARGIN = 30.0  # seconds left when no further record is started
+# Combined records of closed coalescing windows, scanned alongside messages
+AGGREGATE_PREFIX = f"{ingestion.COALESCE_PREFIX}aggregates/"
+
+
+class RateLimiter:
+    """Spaces out calls across threads to at most `rate` per second."""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def is_aggregate(record: Dict[str, Any]) -> bool:
+    """Whether a stored record is a coalescing window's aggregate."""
+    return "window_id" in record and "fragments" in record
+
+
+def stale_stages(record: Dict[str, Any]) -> List[str]:
+    """List the enrichment stages a stored record needs to re-run.
+
+    Args:
+        record: Persisted WhatsApp message or coalescing aggregate.
+
+    Returns:
+        Subset of ["transcription", "structure"], in the order to run them.
+    """
+    if (record.get("enrichment") or {}).get("status") == "queued":
+        # Still waiting on its work queue, whose consumer will enrich it
+        return []
+    stages = []
+    if record.get("type") == "audio" and record.get("audio_file"):
+        if not (record.get("transcription") or {}).get("ok"):
+            stages.append("transcription")
+
+    has_text = (
+        is_aggregate(record)
+        or record.get("type") == "text"
+        or "transcription" in stages
+        or (record.get("transcription") or {}).get("ok")
+    )
+    structure = record.get("structure") or {}
+    triaged = record.get("triage") or {}
+    skipped = "coalesce" in record or (
+        "transcription" not in stages
+        and triaged.get("decision") == ingestion.triage.NOT_REPORT
+        and triaged.get("version") == ingestion.triage.RULES_VERSION
+    )
+    if (
+        has_text
+        and not skipped
+        and (not structure.get("ok") or structure.get("version", 0) < ingestion.version)
+    ):
+        stages.append("structure")
+    return stages
+
+
+def reprocess_record(record: Dict[str, Any], stages: List[str]) -> None:
+    """Re-run the given enrichment stages on a record in place.
+
+    Args:
+        record: Persisted WhatsApp message or coalescing aggregate.
+        stages: Stages returned by `stale_stages`.
+    """
+    message_text = None
+    if is_aggregate(record):
+        message_text = record.get("text")
+    elif record.get("type") == "text":
+        message_text = record.get("text", {}).get("body")
+    else:
+        message_text = (record.get("transcription") or {}).get("text")
+
+    if "transcription" in stages:
+        audio_key = record["audio_file"].split(f"s3://{ingestion.S3_BUCKET}/", 1)[-1]
+        media_type = record.get("audio", {}).get("mime_type", "audio/ogg")
+        buffer, audio_digest = ingestion.fetch_audio(audio_key, media_type)
+        with buffer:
+            message_text, record["transcription"] = ingestion.transcribe_audio(
+                buffer, audio_digest, audio_key.rsplit("/", 1)[-1], media_type
+            )
+
+    if "structure" in stages and message_text is not None:
+        ingestion.structure_message_text(record, message_text)
+
+
+def settle_deferral(record: Dict[str, Any]) -> bool:
+    """Drop a record's deferral once no payload is deferred; True if dropped."""
+    if "deferred" not in record or ingestion.deferred_stages(record):
+        return False
+    del record["deferred"]
+    return True
+
+
+def load_checkpoint(job_id: str, prefix: str) -> Dict[str, Any]:
+    """Load a job's checkpoint, or start a new one."""
+    checkpoint = ingestion.read_s3_json(f"{JOB_PREFIX}{job_id}.json")
+    if checkpoint is not None:
+        return checkpoint
+    return {
+        "job_id": job_id,
+        "prefix": prefix,
+        "start_after": "",
+        "done": False,
+        "stats": {"scanned": 0, "reprocessed": 0, "failed": 0},
+    }
+
+
+def save_checkpoint(checkpoint: Dict[str, Any]) -> None:
+    checkpoint["updated_at"] = time.time()
+    ingestion.write_s3_json(f"{JOB_PREFIX}{checkpoint['job_id']}.json", checkpoint)
+
+
+def run_job(
+    job_id: str,
+    prefix: str = "",
+    workers: int = DEFAULT_WORKERS,
+    rate: float = DEFAULT_RATE,
+    deferred: bool = False,
+) -> Dict[str, Any]:
+    """Scan the bucket from the checkpoint and re-enrich stale records.
+
+    Stops early, with the checkpoint saved, once fewer than `STOP_MARGIN`
+    seconds are left in the invocation (see `set_invocation_deadline`).
+
+    Args:
+        job_id: Name of the job; its checkpoint is keyed by it.
+        prefix: Only keys under this prefix are scanned (new jobs only).
+        workers: Records processed at the same time.
+        rate: Maximum records started per second.
+        deferred: Visit the records listed by deferral markers instead
+            (new jobs only; `prefix` is ignored).
+
+    Returns:
+        The saved checkpoint.
+    """
+    checkpoint = load_checkpoint(
+        job_id, ingestion.DEFERRED_PREFIX if deferred else prefix
+    )
+    markers = checkpoint["prefix"] == ingestion.DEFERRED_PREFIX
+    if checkpoint["done"]:
+        return checkpoint
+    stats = checkpoint["stats"]
+    limiter = RateLimiter(rate)
+
+    def out_of_time() -> bool:
+        remaining = ingestion.remaining_time()
+        return remaining is not None and remaining < STOP_MARGIN
+
+    def handle(key: str) -> Optional[str]:
+        """Returns None if the record was not started, else its outcome."""
+        if out_of_time():
+            return None
+        record_key: Optional[str] = key
+        if markers:
+            record_key = (ingestion.read_s3_json(key) or {}).get("key")
+        if not record_key:
+            return "current"
+        record = ingestion.read_s3_json(record_key)
+        if record is None:
+            return "current"
+        stages = stale_stages(record)
+        if not stages:
+            if settle_deferral(record):
+                ingestion.write_s3_json(record_key, record)
+                ingestion.release_deferral(record)
+            return "current"
+        limiter.acquire()
+        try:
+            reprocess_record(record, stages)
+            settled = settle_deferral(record)
+            record["reprocessed"] = {"job_id": job_id, "at": time.time()}
+            ingestion.write_s3_json(record_key, record)
+            if settled:
+                ingestion.release_deferral(record)
+        except Exception:
+            ingestion.logger.exception("Reprocessing %s failed", record_key)
+            return "failed"
+        return "reprocessed"
+
+    paginator = ingestion.s3.get_paginator("list_objects_v2")
+    pages = paginator.paginate(
+        Bucket=ingestion.S3_BUCKET,
+        Prefix=checkpoint["prefix"],
+        StartAfter=checkpoint["start_after"],
+        PaginationConfig={"PageSize": PAGE_SIZE},
+    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page in pages:
+            keys = [
+                content["Key"]
+                for content in page.get("Contents", [])
+                if content["Key"].endswith(".json")
+                and (
+                    markers
+                    or not content["Key"].startswith("_")
+                    or content["Key"].startswith(AGGREGATE_PREFIX)
+                )
+            ]
+            for key, outcome in zip(keys, executor.map(handle, keys)):
+                if outcome is None:
+                    save_checkpoint(checkpoint)
+                    return checkpoint
+                stats["scanned"] += 1
+                if outcome != "current":
+                    stats[outcome] += 1
+                checkpoint["start_after"] = key
+            if page.get("Contents"):
+                checkpoint["start_after"] = max(
+                    checkpoint["start_after"], page["Contents"][-1]["Key"]
+                )
+            save_checkpoint(checkpoint)
+            if out_of_time():
+                return checkpoint
+
+    checkpoint["done"] = True
+    save_checkpoint(checkpoint)
+    return checkpoint
+
+
+def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    """AWS Lambda entrypoint; re-invoke with the same `job_id` until `done`.
+
+    Args:
+        event: `job_id` (required), optional `prefix`, `workers`, `rate` and
+            `deferred`.
+        context: Lambda context, used to stop before the timeout.
+
+    Returns:
+        The job checkpoint, including `done` and progress counters.
+    """
+    ingestion.set_invocation_deadline(context)
+    return run_job(
+        event["job_id"],
+        event.get("prefix", ""),
+        int(event.get("workers", DEFAULT_WORKERS)),
+        float(event.get("rate", DEFAULT_RATE)),
+        bool(event.get("deferred", False)),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--job-id", required=True)
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE)
+    parser.add_argument(
+        "--deferred",
+        action="store_true",
+        help="only visit records deferred while the OpenAI breaker was open",
+    )
+    args = parser.parse_args()
+    print(
+        json.dumps(
+            run_job(args.job_id, args.prefix, args.workers, args.rate, args.deferred)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Cheap local pre-classifier for inbound report texts.
+
+Decides, without calling OpenAI, whether a text can be a report worth
+structuring. Only messages made up entirely of greetings, thanks,
+acknowledgements or emoji are marked "not_report"; anything that mentions
+fishing vocabulary, or is long enough to hold a description, or that the
+rules do not recognise, is sent on as a "report". Every decision records the
+rule that fired and `RULES_VERSION`, so skipped messages can be audited and
+re-run if the rules change.
+
+Bump `RULES_VERSION` whenever a word list or threshold changes.
+"""
+
+import re
+import unicodedata
+from typing import Dict, List
+
+RULES_VERSION = 1
+
+REPORT = "report"
+NOT_REPORT = "not_report"
+
+# Texts with more words than this always go to the model
+MAX_SMALL_TALK_WORDS = 8
+
+# Fishing and enforcement vocabulary (accent-free, lowercase, stems allowed
+# as prefixes): any of these marks the text as a report
+REPORT_STEMS = (
+    "abulon",
+    "agaller",
+    "ancla",
+    "anzuel",
+    "arpon",
+    "arrecife",
+    "arte",
+    "barco",
+    "buce",
+    "buzo",
+    "camaron",
+    "captur",
+    "caguama",
+    "chinchorro",
+    "compresor",
+    "denunci",
+    "embarcacion",
+    "furtiv",
+    "ilegal",
+    "lancha",
+    "langost",
+    "matricula",
+    "nasa",
+    "palangre",
+    "panga",
+    "pepino",
+    "pesc",
+    "pistola",
+    "pulpo",
+    "red",
+    "refugio",
+    "reserva",
+    "robal",
+    "tiburon",
+    "tortuga",
+    "totoaba",
+    "trampa",
+    "vaquita",
+    "veda",
+    "zona",
+)
+
+# Greetings, thanks, acknowledgements and fillers (accent-free, lowercase)
+SMALL_TALK_WORDS = frozenset(
+    """
+    hola holi ola buenas buenos buen dia dias tarde tardes noche noches que tal
+    saludos saludo como esta estas estan gracias muchas mil muchisimas graciass
+    grasias ok okay oki okey va vale sale sip si no nop listo perfecto bien
+    excelente claro entendido enterado enterada de acuerdo igualmente usted
+    ustedes a todos todas amigo amiga amigos jaja jajaja jeje bendiciones
+    bonito feliz gusto mucho un el la los las y e te le les
+    """.split()
+)
+
+_WORD = re.compile(r"[a-z0-9ñ]+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase and strip accents (keeping ñ), for matching against the lists."""
+    decomposed = unicodedata.normalize("NFD", text.lower())
+    stripped = "".join(
+        char
+        for index, char in enumerate(decomposed)
+        if not unicodedata.combining(char)
+        or (char == "\u0303" and decomposed[index - 1 : index] == "n")
+    )
+    return unicodedata.normalize("NFC", stripped)
+
+
+def words(text: str) -> List[str]:
+    return _WORD.findall(normalize(text))
+
+
+def decision(label: str, rule: str) -> Dict[str, object]:
+    return {"decision": label, "rule": rule, "version": RULES_VERSION}
+
+
+def classify(text: str) -> Dict[str, object]:
+    """Classify a message text as a possible report or not.
+
+    Args:
+        text: Message body or transcription.
+
+    Returns:
+        Dict with the `decision` ("report" or "not_report"), the `rule` that
+        decided it and the rules `version`.
+    """
+    tokens = words(text)
+    if not tokens:
+        # Only emoji, punctuation or whitespace
+        return decision(NOT_REPORT, "no_words")
+    if any(token.startswith(REPORT_STEMS) for token in tokens):
+        return decision(REPORT, "report_keyword")
+    if len(tokens) > MAX_SMALL_TALK_WORDS:
+        return decision(REPORT, "long_text")
+    if all(token in SMALL_TALK_WORDS for token in tokens):
+        return decision(NOT_REPORT, "small_talk")
+    return decision(REPORT, "default")